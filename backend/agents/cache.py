@@ -0,0 +1,47 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def make_cache_key(model: str, prompt_version: str, content: str) -> str:
+    """Build a deterministic cache key for an LLM prompt"""
+    return hashlib.sha256(f"{model}:{prompt_version}:{content}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """In-process LLM response cache with exact-match lookup, TTL expiry and LRU eviction
+
+    Entries are keyed by a SHA-256 of model, prompt version and content, so only
+    identical inputs share a value; near-duplicates are deliberately treated as misses.
+    """
+
+    def __init__(self, ttl: int = 3600, max_entries: int = 512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, content: str, model: str, prompt_version: str) -> Optional[str]:
+        """Return a cached value for content produced by model/prompt_version, if any"""
+        now = time.monotonic()
+        self._evict_expired(now)
+
+        key = make_cache_key(model, prompt_version, content)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry["value"]
+
+    def set(self, content: str, value: str, model: str, prompt_version: str):
+        """Store value for content produced by model/prompt_version"""
+        key = make_cache_key(model, prompt_version, content)
+        self._entries[key] = {"value": value, "expires_at": time.monotonic() + self.ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -1,18 +1,87 @@
 from .base import CanvasBaseAgent
-from typing import Dict, Any, Tuple
+from ..cache import ResponseCache
+from ..llm_clients import get_chat_llm
+from ..rate_limit import TokenRateLimiter, estimate_tokens
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+import asyncio
 import logging
+import os
 from langchain_openai import ChatOpenAI
 import aiohttp
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+# Bump these when the corresponding prompt changes so stale cache entries are ignored
+TITLE_PROMPT_VERSION = "title-v1"
+FORMAT_PROMPT_VERSION = "format-v2"
+
+# Static instructions go first and the content last, so the prompt prefix is
+# byte-identical across calls and eligible for provider-side prompt caching
+_FORMAT_PROMPT_PREFIX = """Format CONTENT as HTML for a Canvas LMS announcement. Return ONLY the HTML, no explanations.
+
+RULES:
+- Wrapper: <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">...</div>
+- Headings: h1 20px, h2 16px, h3 12px
+- Numbered lists: <ol>; keep document hierarchy; space sections apart
+- TABLE (exact structure):
+<div style="overflow-x: auto;"><table style="border-collapse: collapse; width: 100%; margin: 15px 0;">
+<thead><tr><th style="border: 1px solid #ddd; padding: 8px; background-color: #f5f6fa;">[header]</th></tr></thead>
+<tbody><tr><td style="border: 1px solid #ddd; padding: 8px;">[data]</td></tr></tbody>
+</table></div>"""
+
+# Fallback table parser states
+_OUTSIDE, _HEADER_ROW, _BODY_ROW = range(3)
+
+_TABLE_OPEN = (
+    '<div style="overflow-x: auto;">'
+    '<table style="border-collapse: collapse; width: 100%; margin: 15px 0;">'
+    '<thead><tr>'
+)
+
+# Exact matches only: a near-duplicate announcement differs in exactly the dates and rooms that matter
+_llm_cache = ResponseCache(ttl=3600)
+
+# Shared across all announcement LLM calls so bursts stay under the provider's quotas
+_rate_limiter = TokenRateLimiter(
+    requests_per_minute=int(os.getenv("OPENAI_RPM_LIMIT", "500")),
+    tokens_per_minute=int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+)
+
+def _mini_llm(**update) -> ChatOpenAI:
+    """Copy the process-wide client as gpt-4o-mini with a 30s timeout, keeping its connection pool"""
+    llm = get_chat_llm()
+    # The timeout lives on the OpenAI client, which model_copy would keep, so swap in one sharing its pool
+    root = llm.root_async_client.with_options(timeout=30)
+    return llm.model_copy(update={
+        "model_name": "gpt-4o-mini",
+        "request_timeout": 30,
+        "root_async_client": root,
+        "async_client": root.chat.completions,
+        **update
+    })
+
+@lru_cache(maxsize=None)
+def _get_llm() -> ChatOpenAI:
+    """Return the shared formatting client, creating it on first use"""
+    return _mini_llm(stream_usage=True)
+
+@lru_cache(maxsize=None)
+def _get_title_llm() -> ChatOpenAI:
+    """Return the shared client for title generation (titles are at most ~14 tokens)"""
+    return _mini_llm(max_tokens=20, temperature=0)
+
 class AnnouncementAgent(CanvasBaseAgent):
     """Agent for managing Canvas announcements"""
 
     async def generate_title(self, content: str) -> str:
         """Generate a title based on the content"""
         try:
-            llm = ChatOpenAI()
+            llm = _get_title_llm()
+            cached_title = _llm_cache.get(content, llm.model_name, TITLE_PROMPT_VERSION)
+            if cached_title:
+                return cached_title
+
             prompt = f"""
             Please create a short, descriptive title (maximum 5-7 words) for this content:
             
@@ -27,13 +96,29 @@ class AnnouncementAgent(CanvasBaseAgent):
             Return only the title, nothing else.
             """
             
-            title = await llm.apredict(prompt)
-            return title.strip()
+            # Titles are capped at 20 output tokens
+            reservation = await _rate_limiter.acquire(estimate_tokens(llm, prompt) + 20)
+            response = await llm.ainvoke(prompt)
+            usage = response.usage_metadata
+            _rate_limiter.settle(reservation, usage["total_tokens"] if usage else None)
+            
+            title = response.content.strip()
+            _llm_cache.set(content, title, llm.model_name, TITLE_PROMPT_VERSION)
+            return title
         except Exception as e:
             logger.error(f"Error generating title: {str(e)}")
             return "Generated Content"  # Fallback title
 
 
+    def _is_preformatted(self, content: str) -> bool:
+        """Detect content that is already wrapped HTML and needs no formatting"""
+        stripped = content.lstrip()
+        if not (stripped.startswith('<div') and '</div>' in stripped):
+            return False
+        # Markdown tokens mean the HTML still embeds content that needs formatting
+        return not ('|' in stripped or '**' in stripped
+                    or any(line.lstrip().startswith('# ') for line in stripped.split('\n')))
+
     def _is_complex_content(self, content: str) -> bool:
             """Detect if content needs complex formatting"""
             complex_indicators = [
@@ -63,64 +148,36 @@ class AnnouncementAgent(CanvasBaseAgent):
         return '\n'.join(formatted_parts)
 
 
+    async def _format_content_with_llm_stream(self, content: str) -> AsyncIterator[str]:
+        """Stream formatted HTML chunks from the LLM as they are generated"""
+        llm = _get_llm()
+        prompt = _FORMAT_PROMPT_PREFIX + "\n\nCONTENT:\n" + content
+        
+        # Formatted HTML is typically about as long as the prompt itself
+        prompt_tokens = estimate_tokens(llm, prompt)
+        reservation = await _rate_limiter.acquire(prompt_tokens * 2)
+        total_tokens = None
+        try:
+            async for chunk in llm.astream(prompt):
+                if chunk.usage_metadata:
+                    total_tokens = chunk.usage_metadata["total_tokens"]
+                if chunk.content:
+                    yield chunk.content
+        finally:
+            _rate_limiter.settle(reservation, total_tokens)
+
     async def _format_content_with_llm(self, content: str) -> str:
         """Use LLM to format content for Canvas announcement with improved table and typography handling"""
         try:
-            llm = ChatOpenAI()
-            
-            prompt = f"""Format the following content for a Canvas LMS announcement, paying special attention to tables and typography.
-
-Rules for formatting:
-1. Tables:
-   - Must be enclosed in proper <table> tags
-   - Each row must use <tr> tags
-   - Headers must use <th> tags
-   - Data cells must use <td> tags
-   - Add borders and padding for readability
-   - Tables must be responsive
-
-2. Typography:
-   - Base font size should be 14px
-   - Headers should use relative sizes:
-     * h1: 20px
-     * h2: 16px
-     * h3: 12px
-   - Line height should be 1.5
-   - Use Arial or sans-serif fonts
-
-3. Structure:
-   - Each section should be clearly separated
-   - Numbered lists should use <ol> tags
-   - Add appropriate spacing between elements
-   - Preserve document hierarchy
-
-Here's the content to format:
-{content}
-
-Required HTML structure:
-<div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">
-  [Main content here with all headers, tables, and lists properly formatted]
-</div>
-
-Tables should follow this structure:
-<div style="overflow-x: auto;">
-  <table style="border-collapse: collapse; width: 100%; margin: 15px 0;">
-    <thead>
-      <tr>
-        <th style="border: 1px solid #ddd; padding: 8px; background-color: #f5f6fa;">[header]</th>
-      </tr>
-    </thead>
-    <tbody>
-      <tr>
-        <td style="border: 1px solid #ddd; padding: 8px;">[data]</td>
-      </tr>
-    </tbody>
-  </table>
-</div>
-
-Return ONLY the formatted HTML, no explanations. Ensure all tables are properly formatted with the exact structure shown above."""
-
-            formatted_content = await llm.apredict(prompt)
+            llm = _get_llm()
+            cached_content = _llm_cache.get(content, llm.model_name, FORMAT_PROMPT_VERSION)
+            if cached_content:
+                return cached_content
+
+            buffer = []
+            async for chunk in self._format_content_with_llm_stream(content):
+                buffer.append(chunk)
+            formatted_content = "".join(buffer)
             
             # Ensure proper wrapping if LLM didn't provide it
             if not formatted_content.strip().startswith('<div'):
@@ -130,169 +187,178 @@ Return ONLY the formatted HTML, no explanations. Ensure all tables are properly
                     </div>
                 '''
             
-            return formatted_content.strip()
+            formatted_content = formatted_content.strip()
+            _llm_cache.set(content, formatted_content, llm.model_name, FORMAT_PROMPT_VERSION)
+            return formatted_content
             
         except Exception as e:
             logger.error(f"Error formatting content with LLM: {str(e)}")
             # Fallback basic formatting with table detection
-            try:
-                # Basic table detection and formatting
-                lines = content.split('\n')
-                formatted_lines = []
-                in_table = False
-                current_table = []
-                
-                for line in lines:
-                    if '|' in line:
-                        if not in_table:
-                            in_table = True
-                            current_table = []
-                        current_table.append(line)
-                    else:
-                        if in_table:
-                            # Format collected table
-                            table_html = self._format_basic_table('\n'.join(current_table))
-                            formatted_lines.append(table_html)
-                            in_table = False
-                            current_table = []
-                        formatted_lines.append(f'<p style="margin: 10px 0;">{line}</p>')
-                
-                # Handle any remaining table
-                if current_table:
-                    table_html = self._format_basic_table('\n'.join(current_table))
-                    formatted_lines.append(table_html)
+            return self._format_basic_content(content)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _format_basic_content(content: str) -> str:
+        """Basic formatting with markdown table detection for the fallback case (pure, so memoized)"""
+        try:
+            # Single pass over the lines: OUTSIDE -> HEADER_ROW -> BODY_ROW -> OUTSIDE
+            parts = []
+            state = _OUTSIDE
+            
+            for line in content.split('\n'):
+                if '|' in line:
+                    if state == _OUTSIDE:
+                        parts.append(_TABLE_OPEN)
+                        parts.extend(
+                            f'<th style="border: 1px solid #ddd; padding: 8px; background-color: #f5f6fa;">{cell.strip()}</th>'
+                            for cell in line.strip().split('|')[1:-1]
+                        )
+                        parts.append('</tr></thead><tbody>')
+                        state = _HEADER_ROW
+                    elif state == _HEADER_ROW:
+                        # Row after the header is the |---| separator
+                        state = _BODY_ROW
+                    elif not line.strip().startswith('|-'):
+                        parts.append('<tr>')
+                        parts.extend(
+                            f'<td style="border: 1px solid #ddd; padding: 8px;">{cell.strip()}</td>'
+                            for cell in line.strip().split('|')[1:-1]
+                        )
+                        parts.append('</tr>')
+                else:
+                    if state != _OUTSIDE:
+                        parts.append('</tbody></table></div>\n')
+                        state = _OUTSIDE
+                    parts.append(f'<p style="margin: 10px 0;">{line}</p>\n')
+            
+            # Close any table still open at the end of the content
+            if state != _OUTSIDE:
+                parts.append('</tbody></table></div>\n')
+            
+            return (
+                '<div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">\n'
+                f'{"".join(parts)}</div>'
+            )
+        except Exception:
+            # Ultimate fallback
+            return f'''
+                <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">
+                    {content}
+                </div>
+            '''
+
+    async def _format_message(self, message: str, force_reformat: bool = False) -> str:
+        """Format message based on content type"""
+        if not force_reformat and self._is_preformatted(message):
+            logger.info("Content is already formatted HTML, skipping formatting")
+            return message.strip()
+        if self._is_complex_content(message):
+            logger.info("Using complex formatting for content with special elements")
+            return await self._format_content_with_llm(message)
+        logger.info("Using simple formatting for basic content")
+        return await self._format_simple_content(message)
+
+    async def _upload_attachment(self, course_id: str, file_content: bytes,
+                                 file_name: str) -> Tuple[Optional[str], Optional[str]]:
+        """Upload a file for an announcement, returning (file_url, error)"""
+        try:
+            # Step 1: Request file upload URL
+            pre_upload_response = await self.session.post(
+                f"{self.base_url}/api/v1/courses/{course_id}/files",
+                headers=self.headers,
+                json={
+                    'name': file_name,
+                    'size': len(file_content),
+                    'content_type': 'application/octet-stream',
+                    'parent_folder_path': 'announcement_uploads'
+                }
+            )
+            
+            if pre_upload_response.status != 200:
+                logger.error(f"Failed to get upload URL: {await pre_upload_response.text()}")
+                return None, "Failed to get file upload URL"
                 
-                return f'''
-                    <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">
-                        {'\n'.join(formatted_lines)}
-                    </div>
-                '''
-            except:
-                # Ultimate fallback
-                return f'''
-                    <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">
-                        {content}
-                    </div>
-                '''
+            upload_data = await pre_upload_response.json()
+            upload_url = upload_data.get('upload_url')
+            
+            if not upload_url:
+                return None, "No upload URL provided by Canvas"
+            
+            # Step 2: Upload file content
+            form = aiohttp.FormData()
+            form.add_field('file', 
+                        file_content,
+                        filename=file_name,
+                        content_type='application/octet-stream')
+            
+            async with self.session.post(
+                upload_url,
+                headers={'Authorization': self.headers['Authorization']},
+                data=form
+            ) as upload_response:
+                if upload_response.status not in [200, 201]:
+                    logger.error(f"File upload failed: {await upload_response.text()}")
+                    return None, "Failed to upload file"
 
-    def _format_basic_table(self, table_content: str) -> str:
-        """Basic table formatting for fallback case"""
-        lines = [line.strip() for line in table_content.split('\n') if line.strip()]
-        headers = [cell.strip() for cell in lines[0].split('|')[1:-1]]
-        
-        html = '''
-        <div style="overflow-x: auto;">
-            <table style="border-collapse: collapse; width: 100%; margin: 15px 0;">
-                <thead>
-                    <tr>
-        '''
-        
-        # Add headers
-        for header in headers:
-            html += f'<th style="border: 1px solid #ddd; padding: 8px; background-color: #f5f6fa;">{header}</th>'
-        
-        html += '</tr></thead><tbody>'
-        
-        # Add data rows (skip header and separator rows)
-        for line in lines[2:]:
-            if not line.strip().startswith('|-'):
-                cells = [cell.strip() for cell in line.split('|')[1:-1]]
-                html += '<tr>'
-                for cell in cells:
-                    html += f'<td style="border: 1px solid #ddd; padding: 8px;">{cell}</td>'
-                html += '</tr>'
-        
-        html += '</tbody></table></div>'
-        return html
+                file_data = await upload_response.json()
+                file_id = file_data.get('id')
+                
+                # Step 3: Get file info to get the proper URL
+                async with self.session.get(
+                    f"{self.base_url}/api/v1/files/{file_id}",
+                    headers=self.headers
+                ) as file_info_response:
+                    if file_info_response.status == 200:
+                        file_info = await file_info_response.json()
+                        return file_info.get('url'), None
+                    logger.error("Failed to get file info")
+                    return None, None
+                    
+        except Exception as upload_error:
+            logger.error(f"Error during file upload: {str(upload_error)}")
+            return None, f"File upload error: {str(upload_error)}"
 
     async def create_announcement(self, course_id: str, title: str, message: str, 
                                 is_published: bool = True, file_content: bytes = None,
-                                file_name: str = None) -> Dict[str, Any]:
+                                file_name: str = None, force_reformat: bool = False) -> Dict[str, Any]:
         """Create a course announcement with optional file attachment"""
         try:
             await self._ensure_session()
             
-            # If title is default, generate a new one
-            if title == "Generated Content":
-                title = await self.generate_title(message)
-            
-            # Determine if content needs complex formatting
-            needs_complex_formatting = self._is_complex_content(message)
+            # Title generation, formatting and file upload are independent, so run them concurrently
+            tasks = {}
             
-            # Format message based on content type
-            if needs_complex_formatting:
-                logger.info("Using complex formatting for content with special elements")
-                formatted_message = await self._format_content_with_llm(message)
+            if (not force_reformat and title and title != "Generated Content"
+                    and message.lstrip().startswith('<')):
+                # Caller already supplied a title and HTML, so no LLM work is needed
+                logger.info("Using caller-provided title and HTML message as-is")
             else:
-                logger.info("Using simple formatting for basic content")
-                formatted_message = await self._format_simple_content(message)
+                # If title is default, generate a new one
+                if title == "Generated Content":
+                    tasks['title'] = self.generate_title(message)
+                
+                tasks['message'] = self._format_message(message, force_reformat)
             
             # Handle file upload if provided
             if file_content and file_name:
-                try:
-                    # Step 1: Request file upload URL
-                    pre_upload_response = await self.session.post(
-                        f"{self.base_url}/api/v1/courses/{course_id}/files",
-                        headers=self.headers,
-                        json={
-                            'name': file_name,
-                            'size': len(file_content),
-                            'content_type': 'application/octet-stream',
-                            'parent_folder_path': 'announcement_uploads'
-                        }
+                tasks['upload'] = self._upload_attachment(course_id, file_content, file_name)
+            
+            results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+            title = results.get('title', title)
+            formatted_message = results.get('message', message.strip())
+            
+            if 'upload' in results:
+                file_url, upload_error = results['upload']
+                if upload_error:
+                    return {"error": upload_error}
+                if file_url:
+                    # Add file link with simple styling
+                    formatted_message += (
+                        f'\n\n<p style="margin-top: 20px; padding: 10px; '
+                        f'border: 1px solid #e0e0e0; border-radius: 4px;">'
+                        f'Attached file: <a href="{file_url}" '
+                        f'target="_blank" style="color: #2196F3;">{file_name}</a></p>'
                     )
-                    
-                    if pre_upload_response.status != 200:
-                        logger.error(f"Failed to get upload URL: {await pre_upload_response.text()}")
-                        return {"error": "Failed to get file upload URL"}
-                        
-                    upload_data = await pre_upload_response.json()
-                    upload_url = upload_data.get('upload_url')
-                    
-                    if not upload_url:
-                        return {"error": "No upload URL provided by Canvas"}
-                    
-                    # Step 2: Upload file content
-                    form = aiohttp.FormData()
-                    form.add_field('file', 
-                                file_content,
-                                filename=file_name,
-                                content_type='application/octet-stream')
-                    
-                    async with self.session.post(
-                        upload_url,
-                        headers={'Authorization': self.headers['Authorization']},
-                        data=form
-                    ) as upload_response:
-                        if upload_response.status in [200, 201]:
-                            file_data = await upload_response.json()
-                            file_id = file_data.get('id')
-                            
-                            # Step 3: Get file info to get the proper URL
-                            async with self.session.get(
-                                f"{self.base_url}/api/v1/files/{file_id}",
-                                headers=self.headers
-                            ) as file_info_response:
-                                if file_info_response.status == 200:
-                                    file_info = await file_info_response.json()
-                                    file_url = file_info.get('url')
-                                    if file_url:
-                                        # Add file link with simple styling
-                                        formatted_message += (
-                                            f'\n\n<p style="margin-top: 20px; padding: 10px; '
-                                            f'border: 1px solid #e0e0e0; border-radius: 4px;">'
-                                            f'Attached file: <a href="{file_url}" '
-                                            f'target="_blank" style="color: #2196F3;">{file_name}</a></p>'
-                                        )
-                                else:
-                                    logger.error("Failed to get file info")
-                        else:
-                            logger.error(f"File upload failed: {await upload_response.text()}")
-                            return {"error": "Failed to upload file"}
-                            
-                except Exception as upload_error:
-                    logger.error(f"Error during file upload: {str(upload_error)}")
-                    return {"error": f"File upload error: {str(upload_error)}"}
             
             # Create the announcement
             payload = {
@@ -329,6 +395,17 @@ Return ONLY the formatted HTML, no explanations. Ensure all tables are properly
             logger.error(f"Error creating announcement: {str(e)}")
             return {"error": str(e)}
 
+    async def create_announcements_bulk(self, items: List[Dict[str, Any]],
+                                        max_concurrency: int = 10) -> List[Dict[str, Any]]:
+        """Create several announcements concurrently; each item holds create_announcement kwargs"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def create(item: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.create_announcement(**item)
+
+        return await asyncio.gather(*(create(item) for item in items))
+
     async def get_announcements(self, course_id: str) -> Dict[str, Any]:
         """Get all announcements for a course"""
         try:
@@ -359,7 +436,7 @@ Return ONLY the formatted HTML, no explanations. Ensure all tables are properly
             if title:
                 payload['title'] = title
             if message:
-                payload['message'] = f'<p>{message}</p>'
+                payload['message'] = await self._format_message(message)
                 
             async with self.session.put(
                 f"{self.base_url}/api/v1/courses/{course_id}/discussion_topics/{announcement_id}",
@@ -2,8 +2,8 @@ from .base import CanvasBaseAgent
 from typing import Dict, Any, List, Optional, Union
 import logging
 import re
+import asyncio
 from datetime import datetime, timezone
-import json
 from datetime import datetime, timezone, timedelta  
 import aiohttp
 
@@ -23,48 +23,88 @@ class AssignmentAgent(CanvasBaseAgent):
         "on paper": ["on_paper"],
         "online": ["online_text_entry", "online_url", "online_upload", "media_recording"]
     }
+
+    # Patterns are compiled once per class rather than looked up on every call
+    _Q_TOKEN = re.compile(r'(?P<number>\d+\.)|(?P<options>Options:)|\(Correct Answer:\s*(?P<answer>[A-D])\)')
+    _Q_LINE = re.compile(r'q(\d+):\s*(.*)', re.IGNORECASE)
+    _POINTS = re.compile(r'points?\s*(?:should\s*be\s*)?(\d+)')
+    _UTC = timezone.utc
+    _DUE = re.compile(r'due\s*(?:date|on|by)?\s*(\d{1,2}/\d{1,2}/\d{4}\s+\d{1,2}:\d{2}\s*(?:AM|PM|am|pm))', re.IGNORECASE)
+    _TITLE = re.compile(r'title:\s*([^\n]+)')
+    _TEXT = re.compile(r'Text:\s*"([^"]+)"')
+
+    # One alternation over every SUBMISSION_TYPES key; the named group identifies the key
+    _SUBMISSION_RE = re.compile("|".join(
+        f"(?P<g{i}>{re.escape(key)})" for i, key in enumerate(SUBMISSION_TYPES)
+    ))
+    _GROUP_TO_TYPES = {f"g{i}": frozenset(types) for i, types in enumerate(SUBMISSION_TYPES.values())}
+    _DEFAULT_SUBMISSION_TYPES = frozenset({"online_text_entry"})
     
+    # Static markup shared by every format_assignment_content call
+    _ASSIGNMENT_CSS = (
+        "<style>"
+        ".assignment-content{font-family:Arial,sans-serif;line-height:1.6;margin:20px 0}"
+        ".question-block{margin:20px 0;padding:15px;border-left:3px solid #2196F3;background-color:#f8f9fa}"
+        ".question-block h3{color:#2196F3;margin:0 0 10px 0}"
+        ".question-text{margin:0}"
+        "</style>"
+    )
+    _ASSIGNMENT_OPEN = "<div class='assignment-content'>"
+    _ASSIGNMENT_CLOSE = "</div>"
+
+    # parse_questions scanner states
+    _PREAMBLE, _QUESTION_TEXT, _OPTIONS = range(3)
+
     def parse_questions(self, content: str) -> str:
         """Parse questions into HTML format for Canvas"""
-        html_content = "<div class='assignment-questions'>"
-        
-        # Split content into questions
-        questions = re.split(r'\d+\.', content)[1:]  # Skip empty first split
-        
-        for i, question in enumerate(questions, 1):
-            html_content += f"<div class='question'><p><strong>Question {i}.</strong> "
-            
-            # Split into question text and options
-            parts = question.strip().split('Options:', 1)
-            if len(parts) == 2:
-                question_text, options = parts
-                html_content += f"{question_text.strip()}</p>"
-                
-                # Parse options
-                html_content += "<ul class='options'>"
-                options_list = options.strip().split('\n')
-                for option in options_list:
-                    if option.strip().startswith(('A.', 'B.', 'C.', 'D.')):
-                        html_content += f"<li>{option.strip()}</li>"
-                html_content += "</ul>"
-                
-                # Extract correct answer if present
-                correct_match = re.search(r'\(Correct Answer:\s*([A-D])\)', question)
-                if correct_match:
-                    correct_answer = correct_match.group(1)
-                    html_content += f"<p class='correct-answer'><em>Correct Answer: {correct_answer}</em></p>"
-            else:
-                html_content += f"{question.strip()}</p>"
-            
-            html_content += "</div>"
-        
-        html_content += "</div>"
-        return html_content
+        parts = ["<div class='assignment-questions'>"]
+        state = self._PREAMBLE
+        text_start = 0
+        correct_answer = None
+
+        def close_question(end: int):
+            if state == self._QUESTION_TEXT:
+                parts.append(f"{content[text_start:end].strip()}</p></div>")
+                return
+            parts.append("<ul class='options'>")
+            for option in content[text_start:end].strip().split('\n'):
+                option = option.strip()
+                if option.startswith(('A.', 'B.', 'C.', 'D.')):
+                    parts.append(f"<li>{option}</li>")
+            parts.append("</ul>")
+            if correct_answer:
+                parts.append(f"<p class='correct-answer'><em>Correct Answer: {correct_answer}</em></p>")
+            parts.append("</div>")
+
+        # Single scan over question numbers, the options marker and correct answers
+        question_num = 0
+        for match in self._Q_TOKEN.finditer(content):
+            kind = match.lastgroup
+            if kind == 'number':
+                if state != self._PREAMBLE:
+                    close_question(match.start())
+                question_num += 1
+                parts.append(f"<div class='question'><p><strong>Question {question_num}.</strong> ")
+                state, text_start, correct_answer = self._QUESTION_TEXT, match.end(), None
+            elif state == self._PREAMBLE:
+                continue
+            elif kind == 'options':
+                if state == self._QUESTION_TEXT:
+                    parts.append(f"{content[text_start:match.start()].strip()}</p>")
+                    state, text_start = self._OPTIONS, match.end()
+            elif correct_answer is None:
+                correct_answer = match.group('answer')
+
+        if state != self._PREAMBLE:
+            close_question(len(content))
+
+        parts.append("</div>")
+        return "".join(parts)
 
     def format_assignment_content(self, content: str) -> str:
         """Format assignment content with proper HTML structure"""
         try:
-            formatted_content = "<div class='assignment-content'>"
+            parts = [self._ASSIGNMENT_OPEN]
             
             # Split content into lines and process
             lines = content.strip().split('\n')
@@ -77,56 +117,32 @@ class AssignmentAgent(CanvasBaseAgent):
                     continue
                 
                 # Check for question pattern (q1:, q2:, etc.)
-                q_match = re.match(r'q(\d+):\s*(.*)', line, re.IGNORECASE)
+                q_match = self._Q_LINE.match(line)
                 
                 if q_match:
                     # If we have a previous section, add it
                     if current_section:
-                        formatted_content += self._format_section(current_section, section_content)
+                        parts.append(self._format_section(current_section, section_content))
                         section_content = []
                     
                     # Start new question section
                     q_num = q_match.group(1)
                     q_text = q_match.group(2)
-                    formatted_content += f"<div class='question-block'>"
-                    formatted_content += f"<h3>Question {q_num}</h3>"
-                    formatted_content += f"<p class='question-text'>{q_text}</p>"
-                    formatted_content += "</div>"
+                    parts.append(
+                        f"<div class='question-block'><h3>Question {q_num}</h3>"
+                        f"<p class='question-text'>{q_text}</p></div>"
+                    )
                 else:
                     # Regular content
-                    formatted_content += f"<p>{line}</p>"
+                    parts.append(f"<p>{line}</p>")
 
             # Add any remaining section
             if current_section and section_content:
-                formatted_content += self._format_section(current_section, section_content)
+                parts.append(self._format_section(current_section, section_content))
             
-            formatted_content += "</div>"
+            parts.append(self._ASSIGNMENT_CLOSE)
             
-            # Add CSS styling
-            style = """
-            <style>
-                .assignment-content {
-                    font-family: Arial, sans-serif;
-                    line-height: 1.6;
-                    margin: 20px 0;
-                }
-                .question-block {
-                    margin: 20px 0;
-                    padding: 15px;
-                    border-left: 3px solid #2196F3;
-                    background-color: #f8f9fa;
-                }
-                .question-block h3 {
-                    color: #2196F3;
-                    margin: 0 0 10px 0;
-                }
-                .question-text {
-                    margin: 0;
-                }
-            </style>
-            """
-            
-            return style + formatted_content
+            return self._ASSIGNMENT_CSS + "".join(parts)
             
         except Exception as e:
             logger.error(f"Error formatting assignment content: {str(e)}")
@@ -137,66 +153,45 @@ class AssignmentAgent(CanvasBaseAgent):
         if not content:
             return ""
             
-        html = f"<div class='{section_type}-section'>"
+        parts = [f"<div class='{section_type}-section'>"]
         if section_type == "steps":
-            html += "<ol>"
-            for item in content:
-                html += f"<li>{item}</li>"
-            html += "</ol>"
+            parts.append("<ol>")
+            parts.extend(f"<li>{item}</li>" for item in content)
+            parts.append("</ol>")
         else:
-            for item in content:
-                html += f"<p>{item}</p>"
-        html += "</div>"
-        return html
+            parts.extend(f"<p>{item}</p>" for item in content)
+        parts.append("</div>")
+        return "".join(parts)
 
     def parse_submission_types(self, query: str) -> List[str]:
         """Extract submission types from query"""
-        submission_types = []
-        query_lower = query.lower()
-        
-        # Check for specific submission type mentions
-        for key, values in self.SUBMISSION_TYPES.items():
-            if key in query_lower:
-                submission_types.extend(values)
-                
-        # Default to online text entry if no specific type mentioned
-        if not submission_types:
-            submission_types = ["online_text_entry"]
-            
-        return list(set(submission_types))
+        # Union the precomputed type sets of every mention found in a single scan,
+        # defaulting to online text entry if no specific type is mentioned
+        submission_types = frozenset().union(
+            *(self._GROUP_TO_TYPES[match.lastgroup] for match in self._SUBMISSION_RE.finditer(query.lower()))
+        )
+        return list(submission_types or self._DEFAULT_SUBMISSION_TYPES)
 
     def parse_points(self, query: str) -> int:
         """Extract points from query"""
-        points_match = re.search(r'points?\s*(?:should\s*be\s*)?(\d+)', query.lower())
+        points_match = self._POINTS.search(query.lower())
         return int(points_match.group(1)) if points_match else 100
 
     def parse_due_date(self, query: str) -> Optional[str]:
         """Extract due date from query and convert to Canvas-compatible ISO 8601 format"""
         try:
-            # First look for the date pattern
-            date_patterns = [
-                # Match format like "12/7/2024 10:00 PM"
-                r'due\s*(?:date|on|by)?\s*(\d{1,2}/\d{1,2}/\d{4}\s+\d{1,2}:\d{2}\s*(?:AM|PM|am|pm))',
-            ]
-            
-            for pattern in date_patterns:
-                match = re.search(pattern, query, re.IGNORECASE)
-                if match:
-                    date_str = match.group(1).strip()
-                    try:
-                        # Parse the datetime
-                        dt = datetime.strptime(date_str, "%m/%d/%Y %I:%M %p")
-                        
-                        # Convert to user's timezone (assuming UTC for now)
-                        local_tz = timezone.utc
-                        dt = dt.replace(tzinfo=local_tz)
-                        
-                        # Format in Canvas's expected format (ISO 8601 with timezone)
-                        return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-                        
-                    except ValueError as e:
-                        logger.error(f"Error parsing date '{date_str}': {str(e)}")
-                        return None
+            # Match format like "12/7/2024 10:00 PM"
+            match = self._DUE.search(query)
+            if match:
+                date_str = match.group(1).strip()
+                try:
+                    # Assume UTC for now; Canvas expects ISO 8601 with a Z suffix
+                    dt = datetime.strptime(date_str, "%m/%d/%Y %I:%M %p").replace(tzinfo=self._UTC)
+                    return dt.isoformat(timespec='seconds').replace('+00:00', 'Z')
+                    
+                except ValueError as e:
+                    logger.error(f"Error parsing date '{date_str}': {str(e)}")
+                    return None
             
             logger.info("No valid date pattern found in query")
             return None
@@ -297,6 +292,10 @@ class AssignmentAgent(CanvasBaseAgent):
             ) as upload_response:
                 if upload_response.status in [200, 201]:
                     file_data = await upload_response.json()
+                    
+                    # Canvas usually includes the URL in the upload confirmation, saving a round trip
+                    if file_data.get('url'):
+                        return file_data['url']
                     file_id = file_data.get('id')
                     
                     # Step 3: Get file URL
@@ -451,30 +450,32 @@ Return ONLY the formatted HTML, no explanations. Ensure all tables are properly
         try:
             await self._ensure_session()
             
-            # Format the content based on type
-            formatted_description = await self._format_content_with_llm(description)
-
-            
-            # Handle file upload if provided
+            # Format the content and upload any file concurrently, they are independent
             file_url = None
             if file_content and file_name:
-                file_url = await self.upload_file(course_id, file_content, file_name)
-                if file_url:
-                    # Append file link to description with consistent styling
-                    file_html = f'''
-                        <div style="margin-top: 20px; padding: 12px; 
-                                border: 1px solid #e0e0e0; border-radius: 4px; 
-                                background-color: #f8f9fa;">
-                            <p style="margin: 0;">
-                                Attached file: <a href="{file_url}" 
-                                            target="_blank" 
-                                            style="color: #2196F3; text-decoration: none;">
-                                            {file_name}
-                                            </a>
-                            </p>
-                        </div>
-                    '''
-                    formatted_description = formatted_description + file_html
+                formatted_description, file_url = await asyncio.gather(
+                    self._format_content_with_llm(description),
+                    self.upload_file(course_id, file_content, file_name)
+                )
+            else:
+                formatted_description = await self._format_content_with_llm(description)
+            
+            if file_url:
+                # Append file link to description with consistent styling
+                file_html = f'''
+                    <div style="margin-top: 20px; padding: 12px; 
+                            border: 1px solid #e0e0e0; border-radius: 4px; 
+                            background-color: #f8f9fa;">
+                        <p style="margin: 0;">
+                            Attached file: <a href="{file_url}" 
+                                        target="_blank" 
+                                        style="color: #2196F3; text-decoration: none;">
+                                        {file_name}
+                                        </a>
+                        </p>
+                    </div>
+                '''
+                formatted_description = formatted_description + file_html
 
             # Create the assignment payload
             payload = {
@@ -491,19 +492,12 @@ Return ONLY the formatted HTML, no explanations. Ensure all tables are properly
             if due_date:
                 payload['assignment']['due_at'] = due_date
 
-            # Create a safe payload for logging (without file content)
-            log_payload = {
-                'assignment': {
-                    'name': name,
-                    'points_possible': points,
-                    'submission_types': submission_types or ["online_text_entry"],
-                    'has_file_attachment': bool(file_url),
-                    'file_name': file_name if file_url else None,
-                    'due_date': due_date if due_date else None
-                }
-            }
-            
-            logger.info(f"Creating assignment with payload: {json.dumps(log_payload, indent=2)}")
+            # Log without file content; formatting is deferred until the record is emitted
+            logger.info(
+                "Creating assignment %s: points=%s types=%s file=%s due=%s",
+                name, points, payload['assignment']['submission_types'],
+                file_name if file_url else None, due_date
+            )
             
             # Make the API request to create the assignment
             async with self.session.post(
@@ -528,36 +522,39 @@ Return ONLY the formatted HTML, no explanations. Ensure all tables are properly
             logger.error(f"Error creating assignment: {str(e)}")
             return {"error": str(e)}     
             
+    async def create_assignments_bulk(self, items: List[Dict[str, Any]],
+                                      max_concurrency: int = 10) -> List[Dict[str, Any]]:
+        """Create several assignments concurrently; each item holds create_assignment kwargs"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def create(item: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.create_assignment(**item)
+
+        return await asyncio.gather(*(create(item) for item in items))
+
     async def process_assignment_query(self, query: str, course_id: str, 
                                 file_content: bytes = None, file_name: str = None) -> Dict[str, Any]:
         """Process an assignment creation query with enhanced formatting"""
         try:
             # Extract title/name
             name = "Assignment"  # default name
-            title_match = re.search(r'title:\s*([^\n]+)', query)
+            title_match = self._TITLE.search(query)
             if title_match:
                 name = title_match.group(1).strip()
             
             # Extract text content if specified
-            text_match = re.search(r'Text:\s*"([^"]+)"', query)
+            text_match = self._TEXT.search(query)
             description = text_match.group(1) if text_match else "Assignment Content"
             
             # Parse other parameters
             points = self.parse_points(query)
             submission_types = self.parse_submission_types(query)
             
-            # Create log-safe data structure
-            log_data = {
-                "query_info": {
-                    "title": name,
-                    "has_file": bool(file_content),
-                    "file_name": file_name if file_name else None,
-                    "points": points,
-                    "submission_types": submission_types
-                }
-            }
-            
-            logger.info(f"Processing assignment query: {json.dumps(log_data, indent=2)}")
+            logger.info(
+                "Processing assignment query: title=%s points=%s types=%s file=%s",
+                name, points, submission_types, file_name if file_content else None
+            )
             
             # Create the assignment
             return await self.create_assignment(
@@ -19,7 +19,10 @@ class CanvasBaseAgent:
     async def _ensure_session(self):
         """Ensure aiohttp session is created"""
         if not self.session:
-            self.session = aiohttp.ClientSession()
+            # Pooled connector with DNS caching so Canvas connections are reused across calls
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60)
+            )
 
     async def close(self):
         """Close the session"""
@@ -2,8 +2,10 @@ from .base import CanvasBaseAgent
 from .announcement import AnnouncementAgent
 from .assignment import AssignmentAgent
 from .quiz import QuizAgent
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+import asyncio
 import logging
+import time
 import aiohttp
 import re
 from langchain_openai import ChatOpenAI
@@ -11,6 +13,37 @@ from .Pages import PagesAgent
 
 logger = logging.getLogger(__name__)
 
+# Patterns used on every Canvas request, compiled once at import
+COURSE_RE = re.compile(r'\[(.*?)\]')
+URL_RE = re.compile(r'https?://[^\s<>"\']+|www\.[^\s<>"\']+')
+# Double-quoted, single-quoted, then rest-of-line "Text:" bodies, tried in that order
+TEXT_RES = (
+    re.compile(r'Text:\s*"([^"]+)"'),
+    re.compile(r'Text:\s*\'([^\']+)\''),
+    re.compile(r'Text:\s*([^\n]+)'),
+)
+QUESTION_SPLIT_RE = re.compile(r'\d+\.\s+')
+OPTION_RES = {letter: re.compile(fr'{letter}\.\s*([^A-D\(]+)') for letter in 'ABCD'}
+CORRECT_ANSWER_RE = re.compile(r'\(Correct Answer:\s*([A-D])\)')
+
+# Course ids are stable, but a course may be renamed or created mid-session
+COURSE_ID_TTL = 3600
+# Seconds a fetched course list is served from memory
+COURSES_TTL = 60
+# Map of keywords to Canvas submission types
+SUBMISSION_TYPE_KEYWORDS = {
+    "text entry": frozenset({"online_text_entry"}),
+    "website url": frozenset({"online_url"}),
+    "file upload": frozenset({"online_upload"}),
+    "media recording": frozenset({"media_recording"}),
+    "student annotation": frozenset({"student_annotation"}),
+    "external tool": frozenset({"external_tool"}),
+    "no submission": frozenset({"none"}),
+    "on paper": frozenset({"on_paper"}),
+    "online": frozenset({"online_text_entry", "online_url", "online_upload", "media_recording"})
+}
+DEFAULT_SUBMISSION_TYPES = frozenset({"online_text_entry"})
+
 class CanvasPostAgent:
     """Main agent for Canvas operations with improved direct posting capabilities"""
     
@@ -29,13 +62,18 @@ class CanvasPostAgent:
         self.quiz_agent = QuizAgent(self.api_key, self.base_url)
         self.pages_agent = PagesAgent(self.api_key, self.base_url)
         self.llm = ChatOpenAI()  # For title generation if needed
+        # Resolved course ids as (id, expires_at), keyed by the lowercased course name
+        self._course_ids: Dict[str, Tuple[str, float]] = {}
+        # Last non-empty course list as (courses, expires_at); the lock lets one caller fetch it
+        self._courses: Optional[Tuple[List[Dict[str, Any]], float]] = None
+        self._courses_lock = asyncio.Lock()
 
     def parse_structured_quiz(self, content: str) -> List[Dict[str, Any]]:
         """Parse structured quiz content"""
         try:
             questions = []
             # Split into questions (now handling repeated question numbers)
-            question_blocks = re.split(r'\d+\.\s+', content)
+            question_blocks = QUESTION_SPLIT_RE.split(content)
             question_blocks = [q.strip() for q in question_blocks if q.strip()]
 
             for block in question_blocks:
@@ -52,14 +90,13 @@ class CanvasPostAgent:
                         
                         # Extract each option
                     for letter in ['A', 'B', 'C', 'D']:
-                        pattern = fr'{letter}\.\s*([^A-D\(]+)'
-                        match = re.search(pattern, options_text)
+                        match = OPTION_RES[letter].search(options_text)
                         if match:
                                 option_text = match.group(1).strip()
                                 options.append((letter, option_text))
 
                         # Extract correct answer
-                        correct_match = re.search(r'\(Correct Answer:\s*([A-D])\)', block)
+                        correct_match = CORRECT_ANSWER_RE.search(block)
                         if not correct_match:
                             continue
                         
@@ -148,7 +185,18 @@ class CanvasPostAgent:
     async def _ensure_session(self):
         """Ensure aiohttp session is created"""
         if not self.session:
-            self.session = aiohttp.ClientSession()
+            # Pooled connector with DNS caching so Canvas connections are reused across calls
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300,
+                                               keepalive_timeout=60)
+            )
+
+    async def open(self):
+        """Create one pooled session up front and share it with the sub-agents"""
+        await self._ensure_session()
+        for agent in (self.announcement_agent, self.assignment_agent, self.quiz_agent, self.pages_agent):
+            if agent.session is None:
+                agent.session = self.session
 
     def _extract_title(self, message: str) -> Optional[str]:
         """Extract title from message if specified with 'title:' prefix"""
@@ -166,32 +214,14 @@ class CanvasPostAgent:
         
     def parse_submission_types(self, message: str) -> List[str]:
         """Parse submission types from message"""
-        submission_types = []
         message_lower = message.lower()
-
-        # Map of keywords to Canvas submission types
-        type_mapping = {
-            "text entry": ["online_text_entry"],
-            "website url": ["online_url"],
-            "file upload": ["online_upload"],
-            "media recording": ["media_recording"],
-            "student annotation": ["student_annotation"],
-            "external tool": ["external_tool"],
-            "no submission": ["none"],
-            "on paper": ["on_paper"],
-            "online": ["online_text_entry", "online_url", "online_upload", "media_recording"]
-        }
-
-        # Check for each submission type in the message
-        for keyword, types in type_mapping.items():
-            if keyword in message_lower:
-                submission_types.extend(types)
+        # Keywords are phrases, so they stay substring checks; their type sets are unioned once
+        submission_types = frozenset().union(
+            *(types for keyword, types in SUBMISSION_TYPE_KEYWORDS.items() if keyword in message_lower)
+        )
 
         # Default to online text entry if no type specified
-        if not submission_types:
-            submission_types = ["online_text_entry"]
-
-        return list(set(submission_types))
+        return list(submission_types or DEFAULT_SUBMISSION_TYPES)
 
     def _extract_link(self, message: str) -> Optional[str]:
         """Extract link from message if specified with 'link:' prefix or contains URL"""
@@ -205,8 +235,7 @@ class CanvasPostAgent:
                 return message[link_start:link_end].strip()
             
             # If no explicit link:, try to find URL pattern
-            url_pattern = r'https?://[^\s<>"\']+|www\.[^\s<>"\']+'
-            urls = re.findall(url_pattern, message)
+            urls = URL_RE.findall(message)
             if urls:
                 return urls[0]
                 
@@ -235,7 +264,7 @@ class CanvasPostAgent:
             await self._ensure_session()
             
             # Extract course name
-            course_match = re.search(r'\[(.*?)\]', message)
+            course_match = COURSE_RE.search(message)
             if not course_match:
                 return {
                     "success": False,
@@ -243,31 +272,28 @@ class CanvasPostAgent:
                 }
 
             course_name = course_match.group(1)
-            course_id = await self.get_course_id(course_name)
 
+            # Extract title and link if present
+            title = self._extract_title(message)
+            link = self._extract_link(message)
+            structured_quiz = "Questions" in content and "(Correct Answer:" in content
+
+            # Look the course up first so an unknown course doesn't cost a title generation call;
+            # the supervisor's preparation step has usually cached the id already
+            course_id = await self.get_course_id(course_name)
             if not course_id:
                 return {
                     "success": False,
                     "message": f"Could not find course: {course_name}"
                 }
 
-            # Extract title
-            title = self._extract_title(message)
-            if not title:
-                title = "Quiz"  # Default title if none provided
-
-            logger.info(f"Processing {course_name} with title: {title}")
-
             # Handle structured quiz format
-            if "Questions" in content and "(Correct Answer:" in content:
+            if structured_quiz:
+                quiz_title = title or "Quiz"  # Default title if none provided
+                logger.info(f"Processing {course_name} with title: {quiz_title}")
                 logger.info(f"Creating structured quiz in course {course_name}")
-                return await self.handle_structured_quiz(course_id, title, content)
-
+                return await self.handle_structured_quiz(course_id, quiz_title, content)
 
-            # Extract title and link if present
-            title = self._extract_title(message)
-            link = self._extract_link(message)
-            
             # Handle direct link posts
             if link:
                 content = f'<p><a href="{link}" target="_blank">{link}</a></p>'
@@ -330,26 +356,20 @@ class CanvasPostAgent:
                 # Handle page creation first to prevent fallback to announcements
                 if "page" in message_lower or "as a page" in message_lower:
                     logger.info(f"Creating page in course {course_name}")
-                    if hasattr(self, 'pages_agent'):
-                        # Extract text content if present
-                        text_match = re.search(r'Text:\s*"([^"]+)"', message) or \
-                                    re.search(r'Text:\s*\'([^\']+)\'', message) or \
-                                    re.search(r'Text:\s*([^\n]+)', message)
-                        
-                        body = text_match.group(1).strip() if text_match else content
-                        logger.info(f"Extracted content for page: {body}")
-                        
-                        return await self.pages_agent.create_page(
-                            course_id=course_id,
-                            title=title,
-                            body=body,
-                            published=True
-                        )
-                    else:
-                        return {
-                            "success": False,
-                            "message": "Page creation functionality not available"
-                        }
+                    # Extract text content if present
+                    text_match = next(
+                        (match for match in (pattern.search(message) for pattern in TEXT_RES) if match), None
+                    )
+                    
+                    body = text_match.group(1).strip() if text_match else content
+                    logger.info(f"Extracted content for page: {body}")
+                    
+                    return await self.pages_agent.create_page(
+                        course_id=course_id,
+                        title=title,
+                        body=body,
+                        published=True
+                    )
                         
                 # Handle assignment creation
                 elif "assignment" in message_lower:
@@ -482,7 +502,20 @@ class CanvasPostAgent:
         }]
 
     async def list_courses(self) -> List[Dict[str, Any]]:
-        """Get list of all available courses"""
+        """Get list of all available courses, reusing the list fetched in the last COURSES_TTL seconds"""
+        if self._courses and self._courses[1] > time.monotonic():
+            return self._courses[0]
+        async with self._courses_lock:
+            # Another caller may have fetched the list while this one waited
+            if self._courses and self._courses[1] > time.monotonic():
+                return self._courses[0]
+            courses = await self._fetch_courses()
+            if courses:
+                self._courses = (courses, time.monotonic() + COURSES_TTL)
+            return courses
+
+    async def _fetch_courses(self) -> List[Dict[str, Any]]:
+        """Fetch the teacher's courses from Canvas"""
         try:
             await self._ensure_session()
             async with self.session.get(
@@ -510,27 +543,39 @@ class CanvasPostAgent:
             return []
 
     async def get_course_id(self, course_name: str) -> Optional[str]:
-        """Get Canvas course ID from course name"""
+        """Get Canvas course ID from course name, reusing ids found in the last COURSE_ID_TTL seconds"""
         try:
+            key = course_name.lower()
+            cached = self._course_ids.get(key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
             courses = await self.list_courses()
             for course in courses:
-                if course_name.lower() in course['name'].lower():
-                    return str(course['id'])
+                if key in course['name'].lower():
+                    course_id = str(course['id'])
+                    self._course_ids[key] = (course_id, time.monotonic() + COURSE_ID_TTL)
+                    return course_id
             return None
         except Exception as e:
             logger.error(f"Error getting course ID: {str(e)}")
             return None
 
     async def close(self):
-        """Close the session and all sub-agent sessions"""
-        try:
-            if self.session:
-                await self.session.close()
-                self.session = None
-            
-            await self.announcement_agent.close()
-            await self.assignment_agent.close()
-            await self.quiz_agent.close()
-            logger.info("All sessions closed successfully")
-        except Exception as e:
-            logger.error(f"Error closing sessions: {str(e)}")
\ No newline at end of file
+        """Close the session and any sessions the sub-agents opened themselves, concurrently"""
+        closes = []
+        for agent in (self.announcement_agent, self.assignment_agent, self.quiz_agent, self.pages_agent):
+            if agent.session is not None and agent.session is self.session:
+                # Borrowed from open(); this agent owns the session and closes it once below
+                agent.session = None
+            else:
+                closes.append(agent.close())
+        if self.session:
+            closes.append(self.session.close())
+            self.session = None
+        results = await asyncio.gather(*closes, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logger.error(f"Error closing sessions: {str(error)}")
+        if not errors:
+            logger.info("All sessions closed successfully")
\ No newline at end of file
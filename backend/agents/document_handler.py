@@ -1,8 +1,11 @@
+import asyncio
 import logging
-from typing import Dict, Any, BinaryIO
+from io import BytesIO
+from typing import Dict, Any, BinaryIO, Union
 import os
 from dotenv import load_dotenv
 from pathlib import Path
+import shutil
 import tempfile
 import nest_asyncio
 
@@ -66,13 +69,29 @@ class DocumentHandlerAgent:
         # Fallback case if parsed_content is not a list or empty
         return {"text": str(parsed_content), "content_type": "unknown"}
 
-    async def extract_content_with_llamaparse(self, file_content: bytes, filename: str) -> Dict[str, Any]:
+    @staticmethod
+    def _read_file(file: BinaryIO) -> bytes:
+        """Read a file object from the start"""
+        file.seek(0)
+        return file.read()
+
+    @staticmethod
+    def _write_temp_file(file_content: Union[bytes, BinaryIO], suffix: str) -> str:
+        """Write bytes, or copy a file object in chunks, to a named temporary file and return its path"""
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+            if isinstance(file_content, bytes):
+                tmp_file.write(file_content)
+            else:
+                file_content.seek(0)
+                shutil.copyfileobj(file_content, tmp_file, 65536)
+            return tmp_file.name
+
+    async def extract_content_with_llamaparse(self, file_content: Union[bytes, BinaryIO],
+                                              filename: str) -> Dict[str, Any]:
         """Extract content from file using LlamaParse"""
         try:
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=Path(filename).suffix) as tmp_file:
-                tmp_file.write(file_content)
-                tmp_path = tmp_file.name
+            # Create a temporary file; disk writes run in a worker thread to keep the event loop free
+            tmp_path = await asyncio.to_thread(self._write_temp_file, file_content, Path(filename).suffix)
 
             try:
                 # Parse the document using async method
@@ -89,7 +108,7 @@ class DocumentHandlerAgent:
                 
             finally:
                 # Clean up temporary file
-                os.unlink(tmp_path)
+                await asyncio.to_thread(os.unlink, tmp_path)
                 
         except Exception as e:
             logger.error(f"Error in content extraction: {str(e)}")
@@ -109,8 +128,6 @@ class DocumentHandlerAgent:
             extract_mode: Whether to use LlamaParse for extraction
         """
         try:
-            # Read the file content
-            file_content = file.read()
             file_extension = Path(filename).suffix.lower()
             
             if file_extension not in self.supported_extensions:
@@ -123,7 +140,8 @@ class DocumentHandlerAgent:
             # Only use LlamaParse if in extract mode
             if extract_mode and self.llamaparse_api_key:
                 logger.info("Extracting content using LlamaParse")
-                extraction_result = await self.extract_content_with_llamaparse(file_content, filename)
+                # The upload is copied straight into the temp file without a full in-memory read
+                extraction_result = await self.extract_content_with_llamaparse(file, filename)
                 if extraction_result["success"]:
                     formatted_content = extraction_result["content"]
                     return {
@@ -137,8 +155,13 @@ class DocumentHandlerAgent:
                 else:
                     logger.error(f"Content extraction failed: {extraction_result.get('error')}")
             
-            # Return raw content for non-extract mode or if extraction fails
+            # Return raw content for non-extract mode or if extraction fails; only file objects
+            # that may be disk-backed need a worker thread
             logger.info("Returning raw file content without extraction")
+            if isinstance(file, BytesIO):
+                file_content = self._read_file(file)
+            else:
+                file_content = await asyncio.to_thread(self._read_file, file)
             return {
                 "success": True,
                 "content": file_content,
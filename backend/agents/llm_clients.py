@@ -0,0 +1,43 @@
+import importlib.util
+import logging
+import threading
+from typing import Dict, Optional
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the optional h2 package; without it the pool still reuses HTTP/1.1 connections
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_LLM_CACHE: Dict[Optional[str], ChatOpenAI] = {}
+_LLM_LOCK = threading.Lock()
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Return the pooled async HTTP client that concurrent LLM calls are multiplexed on"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=_HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64)
+        )
+    return _http_client
+
+
+def get_chat_llm(api_key: Optional[str] = None) -> ChatOpenAI:
+    """Return the process-wide ChatOpenAI client for an API key (None uses the environment key)
+
+    Sharing the client keeps its HTTP connection pool, and the keep-alive
+    connections in it, alive across supervisors and agent resets.
+    """
+    with _LLM_LOCK:
+        llm = _LLM_CACHE.get(api_key)
+        if llm is None:
+            kwargs = {"api_key": api_key} if api_key else {}
+            llm = ChatOpenAI(http_async_client=_get_http_client(), **kwargs)
+            _LLM_CACHE[api_key] = llm
+            logger.info(f"Created shared ChatOpenAI client (HTTP/2: {_HTTP2_AVAILABLE})")
+        return llm
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import List, Optional
+
+from langchain_core.language_models import BaseLanguageModel
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(llm: BaseLanguageModel, text: str) -> int:
+    """Estimate prompt tokens with the model tokenizer, falling back to ~4 chars per token"""
+    try:
+        return llm.get_num_tokens(text)
+    except Exception as e:
+        logger.debug(f"Tokenizer unavailable, using character estimate: {str(e)}")
+        return len(text) // 4 + 1
+
+
+class TokenRateLimiter:
+    """Sliding-window limiter for LLM requests and tokens per minute
+
+    Callers reserve an estimated token count before a request and settle it with
+    the actual usage afterwards, so unused tokens are refunded to the window.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, window: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._reservations: "deque[List[float]]" = deque()
+        self._lock = asyncio.Lock()
+
+    def _purge(self, now: float):
+        while self._reservations and self._reservations[0][0] <= now - self.window:
+            self._reservations.popleft()
+
+    async def acquire(self, estimated_tokens: int) -> List[float]:
+        """Wait until the request fits in the window and return its reservation"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._purge(now)
+                used = sum(tokens for _, tokens in self._reservations)
+                fits_tokens = used + estimated_tokens <= self.tokens_per_minute or not self._reservations
+                if len(self._reservations) < self.requests_per_minute and fits_tokens:
+                    reservation = [now, estimated_tokens]
+                    self._reservations.append(reservation)
+                    return reservation
+                # Wait for the oldest reservation to leave the window
+                await asyncio.sleep(max(self._reservations[0][0] + self.window - now, 0.01))
+
+    def settle(self, reservation: List[float], actual_tokens: Optional[int]):
+        """Replace a reservation's estimate with the actual token usage, if known"""
+        if actual_tokens is not None:
+            reservation[1] = actual_tokens
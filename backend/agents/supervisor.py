@@ -1,32 +1,340 @@
-from typing import Dict, Any, Optional, List, Union 
+from typing import AsyncIterator, Dict, Any, Literal, Optional, List, Tuple, Union 
+import asyncio
+import os
+from dataclasses import dataclass, field
 from pydantic import BaseModel, Field
 from langchain_openai import ChatOpenAI
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 import logging
+from .cache import ResponseCache, make_cache_key
+from .llm_clients import get_chat_llm
+from .rate_limit import estimate_tokens
 from .web_agent import WebSearchAgent
 from .canvas.post_agent import CanvasPostAgent
 import re
+import sys
+import uuid
 from datetime import datetime, timezone, timedelta  
 import json  
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache, wraps
+import hashlib
+import time
+from itertools import islice
 from .document_handler import DocumentHandlerAgent
 from .rag.pdf_listing_agent import PDFListingAgent
 from .rag.rag_agent import RAGQueryAgent
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class Message(BaseModel):
-    """Message model for communication between agents"""
+# Web search results shared by all supervisors in the process. Matches are exact, since
+# near-duplicate questions ("when is HW1 due" / "HW2") need different answers
+_web_search_cache = ResponseCache(ttl=3600)
+
+# Keyword rules mirroring the LLM routing prompt, checked in order before falling back to the LLM;
+# content-type nouns only count next to a creation or post verb, so questions about them stay with the LLM
+ROUTING_RULES = [
+    (re.compile(r'\bas a page\b|\bcreate (a )?page\b', re.IGNORECASE), "canvas_page"),
+    (re.compile(r'\b(create|generate) (an )?assignment\b', re.IGNORECASE), "canvas_assignment"),
+    (re.compile(r'\b(create|generate|make) (a |an |the |new )?quiz(zes)?\b', re.IGNORECASE), "canvas_quiz"),
+    (re.compile(r'\b(list|show) (my |all |the |available )?courses\b|\bavailable courses\b', re.IGNORECASE), "canvas_list"),
+    (re.compile(r'https?://', re.IGNORECASE), "web_search"),
+    (re.compile(r'\bpost\b.*\bcanvas\b|\b(post|make|create|send)(\s+\S+){0,2}\s+announcements?\b',
+                re.IGNORECASE | re.DOTALL), "canvas_post"),
+]
+# A bracketed course name marks a Canvas command, so a bare content-type noun settles the route;
+# checked after ROUTING_RULES, in the routing prompt's order
+COURSE_ROUTING_RULES = [
+    (re.compile(r'\bpages?\b', re.IGNORECASE), "canvas_page"),
+    (re.compile(r'\bassignments?\b', re.IGNORECASE), "canvas_assignment"),
+    (re.compile(r'\bquizz?(es)?\b', re.IGNORECASE), "canvas_quiz"),
+    (re.compile(r'\b(post|announce|announcements?)\b', re.IGNORECASE), "canvas_post"),
+]
+
+# Patterns used by the request handlers, compiled once at import
+# Explicit "Text:" bodies, tried in the same order as the Canvas agents; an unquoted body must
+# end the message, so multi-line content is still left to the LLM
+TEXT_MARKER_RES = (
+    re.compile(r'Text:\s*"([^"]+)"'),
+    re.compile(r"Text:\s*'([^']+)'"),
+    re.compile(r'Text:\s*([^\n]+)\s*$'),
+)
+# Content types whose "Text:"/"link:" markers hold the whole post
+MARKER_CONTENT_TYPES = frozenset({'announcement', 'page'})
+# Quiz and assignment bodies that are already a numbered or bulleted block after the command
+STRUCTURED_CONTENT_TYPES = frozenset({'quiz', 'assignment'})
+STRUCTURED_LINE_RE = re.compile(r'^[ \t]*(?:\d+\.|[-•*])\s', re.MULTILINE)
+# Lines a structured block may consist of: list items plus quiz options and answer keys
+LIST_LINE_RE = re.compile(r'[ \t]*(?:\d+\.|[-•*]|[A-D][.)]|\(Correct Answer:|Options:)')
+# Metadata the LLM would strip, in the phrasings the parsers accept; a block with any goes to the LLM
+METADATA_RE = re.compile(
+    r'\b(?:title|points?|submission[ _]?types?)\s*:'
+    r'|\bpoints?\s*should\s*be\b|\bworth\s+\d+\s*points?\b|\bdue\b',
+    re.IGNORECASE
+)
+STRUCTURED_CLEAN_MAX_LEN = 2000
+# Messages that pull content from earlier turns, whose cleaned content depends on the context
+REFERS_BACK_RE = re.compile(r'\b(above|previous|earlier|last|same)\b', re.IGNORECASE)
+COURSE_RE = re.compile(r'\[(.*?)\]')
+TITLE_RE = re.compile(r'title:\s*([^\n]+)', re.IGNORECASE)
+POINTS_RE = re.compile(r'points\s*should\s*be\s*(\d+)')
+ASSIGNMENT_RE = re.compile(r'Assignment:(.*?)(?=$)', re.DOTALL)
+# Course, title and link in one scan; each alternative is a lookahead so matches may overlap,
+# e.g. a link on the same line as the title, and the first hit per group equals its own search
+META_RE = re.compile(
+    r'(?=\[(?P<course>.*?)\]'
+    r'|(?i:title:)\s*(?P<title>[^\n]+)'
+    r'|link:(?P<url>https?://[^\s]+))'
+)
+# Interned once so route comparisons in process_message can take the identity fast path
+POST_TYPES = {name: sys.intern(name) for name in ('announcement', 'page', 'assignment', 'quiz')}
+POST_TYPE_RE = re.compile(
+    r'(?P<assignment>create an assignment|post assignment|assignment where)'
+    r'|as a (?:(?P<page>page)|(?P<quiz>quiz))',
+    re.IGNORECASE
+)
+# A message may name several post types; the first of these that it mentions wins
+POST_TYPE_PRIORITY = ('assignment', 'page', 'quiz')
+
+ROUTING_SYSTEM_PROMPT = """Given the user's message, determine if it requires:
+1. rag_query - If it mentions querying PDFs or searching through documents
+2. canvas_page - If it contains 'as a page', 'create page', or any reference to pages
+3. canvas_assignment - If it mentions creating or generating an assignment
+4. canvas_quiz - If it mentions creating or generating a quiz
+5. canvas_list - If it asks about available courses or course listing
+6. web_search - If it contains a URL or asks for web content
+7. canvas_post - If it mentions posting to Canvas or course announcements
+8. general - For general queries
+
+Reply with either 'rag_query', 'canvas_page', 'canvas_assignment', 'canvas_quiz', 'canvas_list', 'web_search', 'canvas_post', or 'general' only.
+Consider these in order:
+1. If the message contains 'as a page' or mentions pages -> 'canvas_page'
+2. If the message contains 'create an assignment' -> 'canvas_assignment'
+3. If the message mentions creating a quiz -> 'canvas_quiz'
+4. If the message asks about listing courses -> 'canvas_list'
+5. If the message contains a URL -> 'web_search'
+6. If the message mentions posting to Canvas -> 'canvas_post'
+7. Otherwise -> 'general'
+
+or else use this:
+If the message contains any reference to searching documents, PDFs, or querying content, choose 'rag_query'."""
+GENERAL_SYSTEM_PROMPT = "Please provide a response considering the conversation history."
+CLEAN_CONTENT_SYSTEM_PROMPT = """You are a content extractor for Canvas LMS. Your task is to extract the actual content that should be posted as the content type named in the request.
+
+Important Guidelines:
+1. For simple posts with Text: markers, just extract that text
+2. For links, just return the URL
+3. For content referencing "above" or "previous", find and extract that content
+4. For assignments, quizzes, or pages, extract the full structured content
+5. Ignore all command language and metadata
+6. Remove course references like [course_name]
+7. Keep the content's original formatting when important (like quiz questions)
+
+Extract and return ONLY the content that should be posted to Canvas as that content type. If the message is asking to reuse previous content, find and extract that content."""
+# Built once so every request of a kind starts from the same prompt prefix
+GENERAL_SYSTEM_MESSAGE = SystemMessage(content=GENERAL_SYSTEM_PROMPT)
+CLEAN_CONTENT_SYSTEM_MESSAGE = SystemMessage(content=CLEAN_CONTENT_SYSTEM_PROMPT)
+ROUTING_SYSTEM_MESSAGE = SystemMessage(content=ROUTING_SYSTEM_PROMPT)
+CLEAN_CONTENT_PROMPT_VERSION = "clean-content-v1"
+ROUTING_PROMPT_VERSION = "routing-v1"
+WEB_SEARCH_PROMPT_VERSION = "web-search-v1"
+WEB_SEARCH_CACHE_NAMESPACE = "web_search"
+ROUTE_CACHE_SIZE = 512
+ROUTE_CACHE_TTL = 24 * 3600
+CLEAN_CACHE_SIZE = 1024
+CLEAN_CACHE_TTL = 600
+ROUTING_BATCH_SIZE = 16
+ROUTE_MAX_TOKENS = 16
+ROUTING_BATCH_WINDOW = 0.02
+MAX_HISTORY = 50
+CONTEXT_WINDOW = 5
+HISTORY_SNIPPET_LEN = 512
+HISTORY_TOKEN_BUDGET = 8000
+MAX_TRACKED_TASKS = 256
+PARSE_OFFLOAD_THRESHOLD = 2048
+# Prefixes of explicit PDF queries; the RAG agent reads the query after the closing bracket
+RAG_QUERY_PREFIXES = ("query the pdf[", "ask the pdf[")
+CONFIRM_WORDS = frozenset({'yes', 'post it', 'post', 'yes post it', 'confirm'})
+CANCEL_WORDS = frozenset({'no', 'cancel', 'dont post', "don't post", 'abort'})
+NON_GENERAL_ROUTES = frozenset({
+    'pdf_listing', 'rag_query', 'document_extraction', 'canvas_quiz', 'canvas_post',
+    'canvas_list', 'canvas_assignment', 'canvas_page', 'web_search'
+})
+CONTEXTLESS_ROUTES = frozenset({'pdf_listing', 'rag_query', 'canvas_list', 'document_extraction'})
+CANCEL_RESPONSES = {
+    "quiz": ("Quiz creation cancelled.", "canvas_quiz"),
+    "announcement": ("Announcement cancelled.", "canvas_post"),
+    "assignment": ("Assignment creation cancelled.", "canvas_assignment"),
+    "page": ("Page creation cancelled.", "canvas_page")
+}
+_ROLE_PREFIX = {"user": "User: ", "assistant": "Assistant: "}
+TIMEOUT_RESPONSE = "The request timed out. Please try again in a moment."
+# Canned answers for one-word openers; only used when the conversation has no earlier turns
+FAST_REPLIES = {
+    "hi": "Hello! How can I help you with your courses today?",
+    "hello": "Hello! How can I help you with your courses today?",
+    "hey": "Hello! How can I help you with your courses today?",
+    "thanks": "You're welcome!",
+    "thank you": "You're welcome!",
+    "bye": "Goodbye! Come back any time."
+}
+
+
+def _scan_metadata(message: str) -> Dict[str, Optional[str]]:
+    """Find the course name, title and link URL of a Canvas request in a single pass"""
+    found = {"course": None, "title": None, "url": None}
+    missing = 3
+    for match in META_RE.finditer(message):
+        group = match.lastgroup
+        if found[group] is None:
+            found[group] = match.group(group)
+            missing -= 1
+            if not missing:
+                break
+    if found["title"] is not None:
+        found["title"] = found["title"].strip()
+    return found
+
+
+def _normalize_for_routing(message_lower: str) -> str:
+    """Normalize a lowercased message so bracketed course names don't fragment the route cache"""
+    return COURSE_RE.sub('[X]', message_lower)
+
+
+@lru_cache(maxsize=ROUTE_CACHE_SIZE)
+def _match_routing_rules(normalized: str) -> Optional[str]:
+    """Return the first keyword route matching a normalized message, if any"""
+    for pattern, route in ROUTING_RULES:
+        if pattern.search(normalized):
+            return route
+    if '[X]' in normalized:
+        for pattern, route in COURSE_ROUTING_RULES:
+            if pattern.search(normalized):
+                return route
+    return None
+
+@dataclass(slots=True, kw_only=True)
+class Message:
+    """Message model for communication between agents; a plain dataclass skips validation per turn"""
     content: str
     type: str = "text"
     role: str  # 'user' or 'assistant'
-    metadata: Dict[str, Any] = Field(default_factory=dict)
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    tokens: int = 0  # counted once when the message is added to the history
 
 class SupervisorState(BaseModel):
     """State management for the supervisor"""
     messages: List[Message] = Field(default_factory=list)
     context: Dict[str, Any] = Field(default_factory=dict)
     current_agent: Optional[str] = None
+    conversation_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+
+def _singleflight(handler):
+    """Coalesce concurrent identical handler calls onto one in-flight execution"""
+    @wraps(handler)
+    async def wrapper(self, message: str, context: str, **kwargs):
+        key = hashlib.blake2b(
+            f"{handler.__name__}|{sorted(kwargs.items())}|{message}|{context[-512:]}".encode(),
+            digest_size=16
+        ).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(handler(self, message, context, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so one caller disconnecting doesn't cancel the call for the others
+        return await asyncio.shield(task)
+    return wrapper
+
+
+RouteName = Literal['rag_query', 'canvas_page', 'canvas_assignment', 'canvas_quiz',
+                    'canvas_list', 'web_search', 'canvas_post', 'general']
+
+class RouteLabel(BaseModel):
+    """Structured routing decision for one message"""
+    route: RouteName
+
+class RouteLabels(BaseModel):
+    """Structured routing decisions for a batch of messages, in message order"""
+    routes: List[RouteName]
+
+class _RoutingBatcher:
+    """Coalesces concurrent routing requests into a single LLM call"""
+
+    def __init__(self, llm: ChatOpenAI, max_batch: int = ROUTING_BATCH_SIZE,
+                 window: float = ROUTING_BATCH_WINDOW):
+        self.llm = llm
+        # Deterministic, length-capped copies of the shared client (same connection pool): a route
+        # is a few JSON tokens, so decoding can't run long and repeat messages get repeat routes
+        router_llm = llm.model_copy(update={"temperature": 0, "max_tokens": ROUTE_MAX_TOKENS})
+        batch_llm = llm.model_copy(update={"temperature": 0, "max_tokens": ROUTE_MAX_TOKENS * max_batch})
+        self._router = router_llm.with_structured_output(RouteLabel)
+        self._batch_router = batch_llm.with_structured_output(RouteLabels)
+        self.max_batch = max_batch
+        self.window = window
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def route(self, message: str) -> str:
+        """Queue a message for the next batch and wait for its route"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                routes = await self._classify([message for message, _ in batch])
+                for (_, future), route in zip(batch, routes):
+                    if not future.done():
+                        future.set_result(route)
+            except Exception as e:
+                logger.error("Error routing batch of %s messages: %s", len(batch), e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _classify(self, messages: List[str]) -> List[str]:
+        # Only the human message varies, so the system prefix stays cacheable by the provider
+        if len(messages) == 1:
+            decision = await self._router.ainvoke([
+                ROUTING_SYSTEM_MESSAGE,
+                HumanMessage(content=f"Message: {messages[0]}")
+            ])
+            return [decision.route]
+
+        numbered = "\n\n".join(f"Message {i}:\n{message}" for i, message in enumerate(messages, 1))
+        decisions = await self._batch_router.ainvoke([
+            ROUTING_SYSTEM_MESSAGE,
+            HumanMessage(content=(
+                f"Route each of the following {len(messages)} messages independently.\n\n{numbered}\n\n"
+                "Return one route per message, in the same order."
+            ))
+        ])
+        routes = decisions.routes[:len(messages)]
+        return routes + ["general"] * (len(messages) - len(routes))
+
+    async def close(self):
+        """Stop the background worker"""
+        if self._worker and not self._worker.done():
+            self._worker.cancel()
+
 
 class CanvasGPTSupervisor:
     """Main supervisor class for orchestrating agent interactions"""
@@ -37,7 +345,9 @@ class CanvasGPTSupervisor:
                 nvidia_api_key: str = None, nvidia_api_url: str = None,
                 pinecone_api_key: str = None,pinecone_index_name: str = None):
         
-        self.llm = ChatOpenAI(api_key=openai_api_key)
+        self.llm = get_chat_llm(openai_api_key)
+        # Extraction results are cached, so they come from a deterministic copy of the client
+        self._clean_llm = self.llm.model_copy(update={"temperature": 0})
         self.web_agent = WebSearchAgent()
         self.canvas_agent = CanvasPostAgent(canvas_api_key, canvas_base_url) if canvas_api_key else None
         self.state = SupervisorState()
@@ -54,7 +364,7 @@ class CanvasGPTSupervisor:
                 )
                 logger.info("PDF listing agent initialized successfully")
             except Exception as e:
-                logger.error(f"Failed to initialize PDF listing agent: {str(e)}")
+                logger.error("Failed to initialize PDF listing agent: %s", e)
                 self.pdf_listing_agent = None
         else:
             self.pdf_listing_agent = None
@@ -75,143 +385,296 @@ class CanvasGPTSupervisor:
                 logger.warning("RAG query agent not initialized - missing NVIDIA credentials")
                 self.rag_agent = None
         except Exception as e:
-            logger.error(f"Failed to initialize RAG query agent: {str(e)}")
+            logger.error("Failed to initialize RAG query agent: %s", e)
             self.rag_agent = None
 
-        self.pending_quiz = None
-        self.pending_announcement = None
-        self.pending_assignment = None
-        self.pending_page = None
+        # The single operation awaiting confirmation, as (kind, data)
+        self.pending: Optional[Tuple[str, Dict[str, Any]]] = None
+        # LLM-resolved routes as (route, expires_at), keyed by model, prompt version and
+        # normalized message (lru_cache can't wrap coroutines)
+        self._route_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # Formatted history and state dump, or None when the state changed since they were built
+        self._history_cache: Optional[List[Dict[str, Any]]] = None
+        self._state_dump: Optional[Dict[str, Any]] = None
+        self._state_bytes: Optional[bytes] = None
+        # Cleaned Canvas content as (content, expires_at), so resending a request skips the LLM
+        self._clean_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._clean_cache_hits = 0
+        self._clean_cache_misses = 0
+        # Joined recent-turn context, or None when the messages changed since it was built
+        self._context_cache: Optional[str] = None
+        # Background handler runs, oldest first, and strong references to the running tasks
+        self._tasks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._background_tasks = set()
+        # Last course list shown and its formatted listing
+        self._course_listing: Optional[Tuple[List[Dict[str, Any]], str]] = None
+        # Running history summarization, if any; at most one at a time
+        self._compaction: Optional[asyncio.Task] = None
+        # Identical handler and content-extraction calls currently running, keyed by input digest
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._routing_batcher = _RoutingBatcher(self.llm)
+        # Admission control for outbound LLM/web calls; a Condition lets the limit change under load
+        self._admit_cond = asyncio.Condition()
+        self._active = 0
+        self._max_inflight = int(os.getenv("SUPERVISOR_MAX_INFLIGHT", "8"))
+        # Longest wait, in seconds, for a web search or for the next chunk of an LLM answer
+        self.llm_timeout = float(os.getenv("SUPERVISOR_LLM_TIMEOUT", "30"))
+        # Set SUPERVISOR_FAST_REPLIES=0 to send greetings to the LLM, e.g. for evaluation
+        self.fast_replies_enabled = os.getenv("SUPERVISOR_FAST_REPLIES", "1") != "0"
+        # Everything holding sessions or pools; close() empties the list so it runs once
+        self._closables = [
+            agent for agent in (self.web_agent, self.canvas_agent, self.document_handler,
+                                self.pdf_listing_agent, self._routing_batcher)
+            if agent is not None
+        ]
         logger.info("CanvasGPT Supervisor initialized")
 
+    @asynccontextmanager
+    async def _admitted(self):
+        """Hold one of the in-flight slots for an outbound call"""
+        async with self._admit_cond:
+            await self._admit_cond.wait_for(lambda: self._active < self._max_inflight)
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._admit_cond:
+                self._active -= 1
+                self._admit_cond.notify(1)
+
+    async def set_max_inflight(self, limit: int):
+        """Change the in-flight call limit, waking waiters if it grew"""
+        async with self._admit_cond:
+            self._max_inflight = max(1, limit)
+            self._admit_cond.notify_all()
+
+    def _reply(self, response: str, agent: str, **extra) -> Dict[str, Any]:
+        """Build a handler result for the current conversation"""
+        return {"response": response, "agent": agent, "conversation_id": self.state.conversation_id, **extra}
+
+    def _mark_state_changed(self):
+        """Invalidate views derived from self.state"""
+        self._history_cache = None
+        self._state_dump = None
+        self._state_bytes = None
+        self._context_cache = None
+
+    def _add_message(self, message: Message):
+        """Append a message to the history, keeping only the most recent MAX_HISTORY"""
+        if not message.tokens:
+            message.tokens = estimate_tokens(self.llm, message.content)
+        history = self._history_cache
+        self.state.messages.append(message)
+        self._mark_state_changed()
+        if history is not None:
+            # Extend the formatted history in place instead of rebuilding one dict per message
+            history.append(self._history_entry(message))
+            self._history_cache = history
+        messages = self.state.messages
+        if len(messages) > MAX_HISTORY:
+            # Drop the oldest turns but keep a leading summary of the compacted ones
+            start = 1 if messages[0].type == "summary" else 0
+            end = start + len(messages) - MAX_HISTORY
+            del messages[start:end]
+            if history is not None:
+                del history[start:end]
+
     def _get_conversation_context(self, current_message: str) -> str:
         """Get recent conversation context"""
         if not self.state.messages:
             return ""
             
-        recent_messages = self.state.messages[-5:]  # Get last 5 messages
-        conversation_parts = []
-        
-        for msg in recent_messages:
-            role = "User" if msg.role == "user" else "Assistant"
-            conversation_parts.append(f"{role}: {msg.content}")
-        
-        return "\n".join(conversation_parts)
+        # Routing, content cleaning and the handlers all ask for it within one turn
+        if self._context_cache is None:
+            # Walk back over the last CONTEXT_WINDOW messages without copying the history
+            recent_messages = reversed(list(islice(reversed(self.state.messages), CONTEXT_WINDOW)))
+            self._context_cache = "\n".join(
+                f"{_ROLE_PREFIX.get(msg.role, 'Assistant: ')}{msg.content}" for msg in recent_messages
+            )
+        return self._context_cache
             
+    def _get_history_messages(self) -> List[BaseMessage]:
+        """Recent conversation turns as chat messages, oldest first, after any earlier-turn summary"""
+        messages = self.state.messages
+        recent_messages = list(reversed(list(islice(reversed(messages), CONTEXT_WINDOW))))
+        history = []
+        if messages and messages[0].type == "summary" and messages[0] is not recent_messages[0]:
+            history.append(SystemMessage(content=f"Summary of the earlier conversation: {messages[0].content}"))
+        history.extend(
+            HumanMessage(content=msg.content) if msg.role == "user" else AIMessage(content=msg.content)
+            for msg in recent_messages
+        )
+        return history
+
+    def _schedule_compaction(self):
+        """Start summarizing older turns in the background once the history exceeds its token budget"""
+        messages = self.state.messages
+        if self._compaction is not None or len(messages) <= CONTEXT_WINDOW:
+            return
+        if sum(msg.tokens for msg in messages) <= HISTORY_TOKEN_BUDGET:
+            return
+        self._compaction = asyncio.create_task(self._compact_history())
+        self._compaction.add_done_callback(lambda _: setattr(self, "_compaction", None))
+
+    async def _compact_history(self):
+        """Roll turns older than the context window into a single leading summary message"""
+        state = self.state
+        older = state.messages[:-CONTEXT_WINDOW]
+        transcript = "\n".join(f"{_ROLE_PREFIX.get(msg.role, 'Assistant: ')}{msg.content}" for msg in older)
+        try:
+            async with self._admitted():
+                result = await self.llm.ainvoke(f"Summarize the following turns concisely:\n\n{transcript}")
+        except Exception as e:
+            # Keep the history intact so the next over-budget turn retries the summary
+            logger.error("Error summarizing conversation history: %s", e)
+            return
+        summary = Message(content=result.content, type="summary", role="assistant")
+        summary.tokens = estimate_tokens(self.llm, summary.content)
+        logger.info("Compacted %s messages into a summary of %s tokens", len(older), summary.tokens)
+        if self.state is not state:
+            return
+        # Turns may have been added or trimmed while the summary ran, so drop the summarized ones by identity
+        summarized = {id(msg) for msg in older}
+        remaining = [msg for msg in state.messages if id(msg) not in summarized]
+        state.messages = [summary, *remaining]
+        self._mark_state_changed()
+
     async def _clean_content_with_llm(self, message: str, content_type: str) -> str:
         """Use LLM to extract clean content for any Canvas LMS content type"""
 
-        # Get conversation context
-        context = self._get_conversation_context(message)
-        
-        prompt = f"""You are a content extractor for Canvas LMS. Your task is to extract the actual content that should be posted as a {content_type}.
-
-        Important Guidelines:
-        1. For simple posts with Text: markers, just extract that text
-        2. For links, just return the URL
-        3. For content referencing "above" or "previous", find and extract that content
-        4. For assignments, quizzes, or pages, extract the full structured content
-        5. Ignore all command language and metadata
-        6. Remove course references like [course_name]
-        7. Keep the content's original formatting when important (like quiz questions)
-
-        Current message:
-        {message}
-
-        Recent conversation:
-        {context}
-        
-        Extract and return ONLY the content that should be posted to Canvas as a {content_type}. If the message is asking to reuse previous content, find and extract that content."""
-
-        clean_content = await self.llm.apredict(prompt)
-        return clean_content.strip()
-
-
-
+        # Guidelines 1 and 2 are mechanical: an explicit text body or link needs no LLM
+        if content_type in MARKER_CONTENT_TYPES:
+            for pattern in TEXT_MARKER_RES:
+                text_match = pattern.search(message)
+                if text_match:
+                    logger.debug("Cleaned %s content locally from its Text: marker", content_type)
+                    return text_match.group(1).strip()
+            url = _scan_metadata(message)["url"]
+            if url:
+                logger.debug("Cleaned %s content locally from its link: marker", content_type)
+                return url
+        elif (content_type in STRUCTURED_CONTENT_TYPES and len(message) <= STRUCTURED_CLEAN_MAX_LEN
+              and not REFERS_BACK_RE.search(message)):
+            # Guideline 7: a formatted question list after the command line is already the content,
+            # as long as every line of it is a list line and none carries metadata
+            first_line = STRUCTURED_LINE_RE.search(message)
+            if first_line:
+                body = message[first_line.start():].strip()
+                lines = [line for line in body.splitlines() if line.strip()]
+                if ('[' not in body and not METADATA_RE.search(body)
+                        and all(LIST_LINE_RE.match(line) for line in lines)):
+                    logger.debug("Cleaned %s content locally from its structured block", content_type)
+                    return body
+
+        # The context changes every turn, so it is only sent and keyed on when the message points back
+        context = self._get_conversation_context(message) if REFERS_BACK_RE.search(message) else ""
+        key = make_cache_key(
+            self._clean_llm.model_name, CLEAN_CONTENT_PROMPT_VERSION, f"{content_type}|{message}|{context}"
+        )
+        cached = self._clean_cache.get(key)
+        if cached and cached[1] > time.monotonic():
+            self._clean_cache.move_to_end(key)
+            self._clean_cache_hits += 1
+            logger.info("Cleaned content cache hit (%s hits, %s misses)",
+                        self._clean_cache_hits, self._clean_cache_misses)
+            return cached[0]
+        self._clean_cache_misses += 1
+
+        # Identical requests arriving together, e.g. a resubmitted form, share one extraction
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._extract_content(key, message, content_type, context))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _extract_content(self, key: str, message: str, content_type: str, context: str) -> str:
+        """Ask the LLM for the content to post and cache it under key"""
+        # Fixed instructions go first as the system message; only the short request varies
+        request = f"Content type: {content_type}\n\nCurrent message:\n{message}"
+        if context:
+            request += f"\n\nRecent conversation:\n{context}"
+        async with self._admitted():
+            result = await self._clean_llm.ainvoke([
+                CLEAN_CONTENT_SYSTEM_MESSAGE,
+                HumanMessage(content=request)
+            ])
+        clean_content = result.content.strip()
 
+        self._clean_cache[key] = (clean_content, time.monotonic() + CLEAN_CACHE_TTL)
+        self._clean_cache.move_to_end(key)
+        if len(self._clean_cache) > CLEAN_CACHE_SIZE:
+            self._clean_cache.popitem(last=False)
+        return clean_content
 
-    async def _route_message(self, message: str) -> str:
-        """Determine which agent should handle the message"""
-        if message.lower().strip() == "show pdfs":
+    async def _route_message(self, message: str, message_lower: str) -> str:
+        """Determine which agent should handle the message; message_lower is its stripped lowercase form"""
+        if message_lower == "show pdfs":
             return "pdf_listing"
         
-        # NEW: Check for extraction requests
-        message_lower = message.lower()
-        if any(keyword in message_lower for keyword in ["extract", "extract data", "extract content", "analyze content"]):
+        # NEW: Check for extraction requests ("extract data"/"extract content" contain "extract")
+        if "extract" in message_lower or "analyze content" in message_lower:
             logger.info("Content extraction request detected")
             if "[" not in message:
                 return "document_extraction"
         
-        if message_lower.startswith("query the pdf["):
+        if message_lower.startswith(RAG_QUERY_PREFIXES):
             logger.info("Routing to RAG query agent")
             return "rag_query"
         
         # First check explicitly for file upload before using GPT
-        if "with the file uploaded" in message.lower():
+        if "with the file uploaded" in message_lower:
             logger.info("File upload detected, routing to appropriate handler")
-            message_lower = message.lower()
             
-            # Updated routing logic for file uploads
-            if ('create an assignment' in message_lower or 
-                'post assignment' in message_lower or 
-                'assignment where' in message_lower):
-                self.state.context['post_type'] = 'assignment'
+            # One scan finds every post type mentioned, picked by priority; otherwise an announcement
+            mentioned = {match.lastgroup for match in POST_TYPE_RE.finditer(message)}
+            post_type = next((kind for kind in POST_TYPE_PRIORITY if kind in mentioned), 'announcement')
+            self.state.context['post_type'] = POST_TYPES[post_type]
+            if self.state.context['post_type'] == 'assignment':
                 logger.info("Assignment with file upload detected")
-            elif 'as a page' in message_lower:
-                self.state.context['post_type'] = 'page'
-            elif 'as a quiz' in message_lower:
-                self.state.context['post_type'] = 'quiz'
-            else:
-                self.state.context['post_type'] = 'announcement'
             
             # Extract text content if present
             if "Assignment:" in message:
-                assignment_match = re.search(r'Assignment:(.*?)(?=$)', message, re.DOTALL)
+                assignment_match = ASSIGNMENT_RE.search(message)
                 if assignment_match:
                     self.state.context["assignment_text"] = assignment_match.group(1).strip()
                     
-            logger.info(f"Document handler route detected. Post type: {self.state.context.get('post_type')}")
+            self._mark_state_changed()
+            logger.info("Document handler route detected. Post type: %s", self.state.context.get('post_type'))
             return self.state.context.get('post_type')
 
-        # Rest of the routing logic remains the same...
-        routing_prompt = f"""
-        Given the following message, determine if it requires:
-        1. rag_query - If it mentions querying PDFs or searching through documents
-        2. canvas_page - If it contains 'as a page', 'create page', or any reference to pages
-        3. canvas_assignment - If it mentions creating or generating an assignment
-        4. canvas_quiz - If it mentions creating or generating a quiz
-        5. canvas_list - If it asks about available courses or course listing
-        6. web_search - If it contains a URL or asks for web content
-        7. canvas_post - If it mentions posting to Canvas or course announcements
-        8. general - For general queries
-
-        Message: {message}
-        
-            Reply with either 'rag_query', 'canvas_page', 'canvas_assignment', 'canvas_quiz', 'canvas_list', 'web_search', 'canvas_post', or 'general' only.
-            Consider these in order:
-            1. If the message contains 'as a page' or mentions pages -> 'canvas_page'
-            2. If the message contains 'create an assignment' -> 'canvas_assignment'
-            3. If the message mentions creating a quiz -> 'canvas_quiz'
-            4. If the message asks about listing courses -> 'canvas_list'
-            5. If the message contains a URL -> 'web_search'
-            6. If the message mentions posting to Canvas -> 'canvas_post'
-            7. Otherwise -> 'general'
+        # Resolve clear-cut intents locally; only ambiguous messages need the LLM
+        normalized = _normalize_for_routing(message_lower)
+        route = _match_routing_rules(normalized)
+        if route:
+            logger.info("Keyword routing matched: %s", route)
+            return route
+
+        key = make_cache_key(self.llm.model_name, ROUTING_PROMPT_VERSION, normalized)
+        cached = self._route_cache.get(key)
+        if cached:
+            if cached[1] > time.monotonic():
+                self._route_cache.move_to_end(key)
+                logger.info("Route cache hit: %s", cached[0])
+                return cached[0]
+            del self._route_cache[key]
 
-            or else use this:
-            If the message contains any reference to searching documents, PDFs, or querying content, choose 'rag_query'.
-            """
+        # Concurrent messages share one routing LLM call
+        route = await self._routing_batcher.route(message)
 
-        response = await self.llm.apredict(routing_prompt)
-        return response.strip().lower()   
+        self._route_cache[key] = (route, time.monotonic() + ROUTE_CACHE_TTL)
+        if len(self._route_cache) > ROUTE_CACHE_SIZE:
+            self._route_cache.popitem(last=False)
+        return route
 
 
 
     def _extract_title(self, message: str) -> Optional[str]:
         """Extract title from message if specified"""
-        if "title:" in message.lower():
-            title_match = re.search(r'title:\s*([^\n]+)', message, re.IGNORECASE)
-            if title_match:
-                return title_match.group(1).strip()
+        # TITLE_RE is case-insensitive, so no lowercased copy of the message is needed
+        title_match = TITLE_RE.search(message)
+        if title_match:
+            return title_match.group(1).strip()
         return None
 
     async def get_available_courses(self) -> List[Dict[str, Any]]:
@@ -251,35 +714,34 @@ class CanvasGPTSupervisor:
         # Fallback for unhandled content types
         return str(content)
 
-    async def process_message(self, message: str, file_content: Optional[Dict] = None) -> Dict[str, str]:
-        """Process incoming messages and route to appropriate agents"""
+    async def process_message(self, message: str, file_content: Optional[Dict] = None,
+                              async_mode: bool = False, *, message_lower: Optional[str] = None) -> Dict[str, str]:
+        """Process incoming messages and route to appropriate agents; async_mode queues web searches
+
+        message_lower is the stripped lowercase message, for callers that already computed it.
+        """
         try:
+            # Handle confirmations first, ignoring surrounding whitespace; they resolve the
+            # pending operation and are kept out of the conversation context
+            lower_message = message_lower if message_lower is not None else message.strip().lower()
+            if lower_message in CONFIRM_WORDS:
+                if self.pending:
+                    return await self._CONFIRMATION_HANDLERS[self.pending[0]](self)
+
+            # Handle cancellations
+            elif lower_message in CANCEL_WORDS:
+                return self._handle_cancellation()
+
             # Add user message to state
-            self.state.messages.append(Message(
+            self._add_message(Message(
                 content=message,
                 type="text",
                 role="user",
                 metadata={"has_file": bool(file_content)}
             ))
 
-            # Handle confirmations first
-            lower_message = message.lower()
-            if lower_message in ['yes', 'post it', 'post', 'yes post it']:
-                if self.pending_quiz:
-                    return await self._handle_quiz_confirmation()
-                elif self.pending_announcement:
-                    return await self._handle_announcement_confirmation()
-                elif self.pending_assignment:
-                    return await self._handle_assignment_confirmation()
-                elif self.pending_page:
-                    return await self._handle_page_confirmation()
-
-            # Handle cancellations
-            elif lower_message in ['no', 'cancel', 'dont post', "don't post"]:
-                return self._handle_cancellation()
-
             # NEW: Handle extraction request
-            if "extract" in message.lower() and file_content and "[" not in message:
+            if "extract" in lower_message and file_content and "[" not in message:
                 logger.info("Processing extraction request")
                 file_result = await self.document_handler.process_file(
                     file_content["file"],
@@ -288,11 +750,10 @@ class CanvasGPTSupervisor:
                 )
                 
                 if not file_result["success"]:
-                    return {
-                        "response": f"Error processing file: {file_result.get('error', 'Unknown error')}",
-                        "agent": "document_handler",
-                        "conversation_id": id(self.state)
-                    }
+                    return self._reply(
+                        f"Error processing file: {file_result.get('error', 'Unknown error')}",
+                        "document_handler"
+                    )
                 
                 # Get the extracted content
                 extracted_content = file_result["content"]
@@ -307,9 +768,10 @@ class CanvasGPTSupervisor:
                 
                 # Store the formatted content for later use
                 self.state.context["extracted_content"] = content_text
+                self._mark_state_changed()
                 
                 # Add extraction result to messages
-                self.state.messages.append(Message(
+                self._add_message(Message(
                     content=f"Here's what I extracted from {file_result['filename']}:\n\n{content_text}",
                     type="text",
                     role="assistant",
@@ -321,81 +783,87 @@ class CanvasGPTSupervisor:
                     }
                 ))
                 
-                return {
-                    "response": f"Here's what I extracted from {file_result['filename']}:\n\n{content_text}",
-                    "agent": "document_handler",
-                    "conversation_id": id(self.state)
-                }
+                return self._reply(
+                    f"Here's what I extracted from {file_result['filename']}:\n\n{content_text}",
+                    "document_handler"
+                )
 
 
-            # Process file if present
+            # Process file if present, overlapping file parsing with routing
             file_result = None
             if file_content:
-                file_result = await self.document_handler.process_file(
-                    file_content["file"],
-                    file_content["filename"]
+                file_result, route = await asyncio.gather(
+                    self.document_handler.process_file(
+                        file_content["file"],
+                        file_content["filename"]
+                    ),
+                    self._route_message(message, lower_message)
                 )
                 
                 if not file_result["success"]:
-                    return {
-                        "response": f"Error processing file: {file_result.get('error', 'Unknown error')}",
-                        "agent": "document_handler",
-                        "conversation_id": id(self.state)
-                    }
+                    return self._reply(
+                        f"Error processing file: {file_result.get('error', 'Unknown error')}",
+                        "document_handler"
+                    )
                 
-                # Add file content to message metadata
-                self.state.messages[-1].metadata.update({
-                    "file_content": file_result["content"],
-                    "file_type": file_result["file_type"],
-                    "filename": file_result["filename"]
-                })
-
-            # Route the message
-            route = await self._route_message(message)
-            logger.info(f"Message routed to: {route}")
+                # Keep history metadata small; the parsed content stays in file_result for the handlers
+                parsed_content = file_result["content"]
+                self._mark_state_changed()
+                metadata = self.state.messages[-1].metadata
+                metadata["file_type"] = file_result["file_type"]
+                metadata["filename"] = file_result["filename"]
+                metadata["file_size"] = len(parsed_content) if hasattr(parsed_content, "__len__") else None
+                # file_result doubles as the handlers' upload payload; each branch adds its "text"
+                file_result["file_content"] = parsed_content
+            elif lower_message in CONFIRM_WORDS:
+                # A stray confirmation with nothing pending needs no routing call
+                route = "general"
+            elif len(self.state.messages) <= 1 and self._fast_reply(lower_message):
+                route = "general"
+            else:
+                # Route the message
+                route = await self._route_message(message, lower_message)
+            logger.info("Message routed to: %s", route)
 
             try:
-                # Initialize context
-                context = self._get_conversation_context(message)
+                # Initialize context; single-turn routes and file uploads never read it
+                if file_content or route in CONTEXTLESS_ROUTES:
+                    context = ""
+                else:
+                    context = self._get_conversation_context(message)
 
                 # Handle different routes based on message type and content
                 if route == "pdf_listing":
                     if not self.pdf_listing_agent:
-                        response = {
-                            "response": "PDF listing is not configured. Please provide AWS credentials.",
-                            "agent": "pdf_listing",
-                            "conversation_id": id(self.state)
-                        }
+                        response = self._reply(
+                            "PDF listing is not configured. Please provide AWS credentials.",
+                            "pdf_listing"
+                        )
                     else:
                         result = await self.pdf_listing_agent.list_book_folders()
                         if result["success"]:
                             formatted_text = result["formatted_output"]
                             # Ensure proper line breaks are preserved
                             formatted_text = formatted_text.replace('\n', '\n')  # Force line break preservation
-                            response = {
-                                "response": f"```markdown\n{formatted_text}\n```",  # Wrap in markdown code block
-                                "agent": "pdf_listing",
-                                "conversation_id": id(self.state),
-                                "success": True
-                            }
+                            # Wrap in markdown code block
+                            response = self._reply(
+                                f"```markdown\n{formatted_text}\n```",
+                                "pdf_listing", success=True
+                            )
                         else:
-                            response = {
-                                "response": f"Error listing PDFs: {result.get('error', 'Unknown error')}",
-                                "agent": "pdf_listing",
-                                "conversation_id": id(self.state),
-                                "success": False
-                            }
+                            response = self._reply(
+                                f"Error listing PDFs: {result.get('error', 'Unknown error')}",
+                                "pdf_listing", success=False
+                            )
 
                 elif route == "rag_query":
-                    logger.info(f"RAG Agent exists: {self.rag_agent is not None}")
+                    logger.info("RAG Agent exists: %s", self.rag_agent is not None)
                     if not self.rag_agent:
                         logger.error("RAG query agent is None - Check NVIDIA API key")
-                        response = {
-                            "response": "RAG query agent is not configured properly.",
-                            "agent": "rag_query",
-                            "conversation_id": id(self.state),
-                            "success": False
-                        }
+                        response = self._reply(
+                            "RAG query agent is not configured properly.",
+                            "rag_query", success=False
+                        )
                     else:
                         try:
                             result = await self.rag_agent.process_query(message)
@@ -410,54 +878,25 @@ class CanvasGPTSupervisor:
                             else:
                                 response_text = result["response"]
                                 
-                            response = {
-                                "response": response_text,
-                                "agent": "rag_query",
-                                "conversation_id": id(self.state)
-                            }
+                            response = self._reply(response_text, "rag_query")
                         except Exception as e:
-                            logger.error(f"Error in RAG query processing: {e}")
-                            response = {
-                                "response": f"Error processing query: {str(e)}",
-                                "agent": "rag_query",
-                                "conversation_id": id(self.state)
-                            }
+                            logger.error("Error in RAG query processing: %s", e)
+                            response = self._reply(f"Error processing query: {str(e)}", "rag_query")
 
                 # Handle file upload cases
                 elif file_content:
                     if route == "assignment":
                         logger.info("Processing assignment with file upload")
-                        return await self._handle_assignment_request(
-                            message,
-                            {
-                                "text": self.state.context.get("assignment_text", ""),
-                                "file_content": file_result["content"],
-                                "filename": file_result["filename"],
-                                "file_type": file_result["file_type"]
-                            }
-                        )
+                        file_result["text"] = self.state.context.get("assignment_text", "")
+                        return await self._handle_assignment_request(message, file_result)
                     elif route == "page":
                         logger.info("Processing page with file upload")
-                        return await self._handle_page_request(
-                            message,
-                            {
-                                "text": self.state.context.get("page_text", ""),
-                                "file_content": file_result["content"],
-                                "filename": file_result["filename"],
-                                "file_type": file_result["file_type"]
-                            }
-                        )
+                        file_result["text"] = self.state.context.get("page_text", "")
+                        return await self._handle_page_request(message, file_result)
                     elif route == "quiz":
                         logger.info("Processing quiz with file upload")
-                        return await self._handle_quiz_request(
-                            message,
-                            {
-                                "text": self.state.context.get("quiz_text", ""),
-                                "file_content": file_result["content"],
-                                "filename": file_result["filename"],
-                                "file_type": file_result["file_type"]
-                            }
-                        )
+                        file_result["text"] = self.state.context.get("quiz_text", "")
+                        return await self._handle_quiz_request(message, file_result)
                     elif route == "document_extraction":
                         logger.info("Processing simple extraction request")
                         file_result = await self.document_handler.process_file(
@@ -467,11 +906,10 @@ class CanvasGPTSupervisor:
                         )
                         
                         if not file_result["success"]:
-                            return {
-                                "response": f"Error processing file: {file_result.get('error', 'Unknown error')}",
-                                "agent": "document_handler",
-                                "conversation_id": id(self.state)
-                            }
+                            return self._reply(
+                                f"Error processing file: {file_result.get('error', 'Unknown error')}",
+                                "document_handler"
+                            )
 
                         if file_result.get("extracted"):
                             content = file_result["content"]
@@ -480,25 +918,16 @@ class CanvasGPTSupervisor:
                                 file_result["file_type"]
                             )
                             
-                            logger.info("Extracted content:")
-                            logger.info(processed_content)
+                            logger.debug("Extracted content: %s", processed_content)
                             
-                            return {
-                                "response": f"Here's what I extracted from the file:\n\n{processed_content}",
-                                "agent": "document_handler",
-                                "conversation_id": id(self.state)
-                            }
+                            return self._reply(
+                                f"Here's what I extracted from the file:\n\n{processed_content}",
+                                "document_handler"
+                            )
                     else:  # Default to announcement
                         logger.info("Processing announcement with file upload")
-                        return await self._handle_post_request(
-                            message,
-                            {
-                                "text": self.state.context.get("announcement_text", "File uploaded"),
-                                "file_content": file_result["content"],
-                                "filename": file_result["filename"],
-                                "file_type": file_result["file_type"]
-                            }
-                        )
+                        file_result["text"] = self.state.context.get("announcement_text", "File uploaded")
+                        return await self._handle_post_request(message, file_result)
                     
 
                 # Handle non-file cases
@@ -513,13 +942,13 @@ class CanvasGPTSupervisor:
                 elif route == "canvas_page":
                     response = await self._handle_page_request(message, context)
                 elif route == "web_search":
-                    response = await self._handle_web_search(message, context)
+                    response = await self._handle_web_search(message, context, async_mode=async_mode)
                 else:
                     response = await self._handle_general_request(message, context)
 
-                # Store assistant response
-                self.state.messages.append(Message(
-                    content=response["response"],
+                # Store a snippet of the assistant response; the caller still gets the full text
+                self._add_message(Message(
+                    content=response["response"][:HISTORY_SNIPPET_LEN],
                     type="text",
                     role="assistant",
                     metadata={"agent": route}
@@ -528,81 +957,68 @@ class CanvasGPTSupervisor:
                 return response
 
             except Exception as e:
-                logger.error(f"Error in route handling: {str(e)}")
+                logger.error("Error in route handling: %s", e)
                 raise
 
         except Exception as e:
-            logger.error(f"Error processing message: {str(e)}")
-            return {
-                "error": f"Error processing message: {str(e)}",
-                "response": f"An error occurred while processing your message: {str(e)}",
-                "agent": "error",
-                "conversation_id": id(self.state)
-            }
+            logger.error("Error processing message: %s", e)
+            return self._reply(
+                f"An error occurred while processing your message: {str(e)}", "error",
+                error=f"Error processing message: {str(e)}"
+            )
    
    
     async def _handle_page_confirmation(self) -> Dict[str, str]:
         """Handle confirmation for page creation"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_page",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_page"
+            )
 
         try:
+            _, pending = self.pending
             result = await self.canvas_agent.process(
-                self.pending_page['content'],
-                f"page for [{self.pending_page['course_name']}] title: {self.pending_page['title']}"
+                pending['content'],
+                f"page for [{pending['course_name']}] title: {pending['title']}"
             )
             
             if result.get('success', False):
-                response = f"Successfully created page in {self.pending_page['course_name']}!"
+                response = f"Successfully created page in {pending['course_name']}!"
             else:
                 response = f"Failed to create page: {result.get('message', 'Unknown error')}"
             
-            self.pending_page = None  # Clear pending page
+            self.pending = None  # Clear pending page
             
-            return {
-                "response": response,
-                "agent": "canvas_page",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(response, "canvas_page")
             
         except Exception as e:
-            logger.error(f"Error creating page: {str(e)}")
-            return {
-                "response": f"Error creating page: {str(e)}",
-                "agent": "canvas_page",
-                "conversation_id": id(self.state)
-            }
+            logger.error("Error creating page: %s", e)
+            return self._reply(f"Error creating page: {str(e)}", "canvas_page")
 
 
 
     async def _handle_page_request(self, message: str, content: Union[str, Dict]) -> Dict[str, str]:
         """Handle page creation requests with URL support"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_page",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_page"
+            )
 
-        course_match = re.search(r'\[(.*?)\]', message)
-        if not course_match:
-            return {
-                "response": "Please specify a course name in square brackets, e.g. [Course Name]",
-                "agent": "canvas_page",
-                "conversation_id": id(self.state)
-            }
+        metadata = _scan_metadata(message)
+        course_name = metadata["course"]
+        if course_name is None:
+            return self._reply(
+                "Please specify a course name in square brackets, e.g. [Course Name]",
+                "canvas_page"
+            )
         
-        course_name = course_match.group(1)
-        title = self._extract_title(message)
+        title = metadata["title"]
         
         # Extract URL if present
-        url_match = re.search(r'link:(https?://[^\s]+)', message)
-        if url_match:
-            url = url_match.group(1)
+        url = metadata["url"]
+        if url:
             # Extract content from URL
             url_content = await self.web_agent.extract_url_content(url)
             if url_content["success"]:
@@ -610,17 +1026,16 @@ class CanvasGPTSupervisor:
                 # Add source reference
                 cleaned_content += f"\n\nSource: {url_content['original_url']}"
             else:
-                return {
-                    "response": f"Failed to extract content from URL: {url_content.get('error', 'Unknown error')}",
-                    "agent": "canvas_page",
-                    "conversation_id": id(self.state)
-                }
+                return self._reply(
+                    f"Failed to extract content from URL: {url_content.get('error', 'Unknown error')}",
+                    "canvas_page"
+                )
         else:
             # Handle regular content
             cleaned_content = await self._clean_content_with_llm(message, "page")
         
         if isinstance(content, dict) and content.get("file_content"):
-            self.pending_page = {
+            pending = {
                 "course_name": course_name,
                 "content": cleaned_content,
                 "title": title,
@@ -628,58 +1043,60 @@ class CanvasGPTSupervisor:
                 "file_name": content.get("filename")
             }
         else:
-            self.pending_page = {
+            pending = {
                 "course_name": course_name,
                 "content": cleaned_content,
                 "title": title
             }
+        self.pending = ("page", pending)
         
+        # Built in one pass, since the content can be long and each += would copy it again
+        attachment = f"File to be attached: {pending['file_name']}\n\n" if "file_content" in pending else ""
         response = (
             f"I've prepared the page for {course_name}:\n"
             f"Title: {title}\n"
             f"Content:\n{cleaned_content}\n\n"
+            f"{attachment}"
+            "Would you like me to create this page? (Reply with 'yes' to create or 'no' to cancel)"
         )
         
-        if "file_content" in self.pending_page:
-            response += f"File to be attached: {self.pending_page['file_name']}\n\n"
-        
-        response += "Would you like me to create this page? (Reply with 'yes' to create or 'no' to cancel)"
-        
-        return {
-            "response": response,
-            "agent": "canvas_page",
-            "conversation_id": id(self.state)
-        }
+        return self._reply(response, "canvas_page")
 
     async def _handle_post_request(self, message: str, content: Union[str, Dict]) -> Dict[str, str]:
         """Handle announcement posting requests"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_post",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_post"
+            )
 
-        course_match = re.search(r'\[(.*?)\]', message)
-        if not course_match:
-            return {
-                "response": "Please specify a course name in square brackets, e.g. [Course Name]",
-                "agent": "canvas_post",
-                "conversation_id": id(self.state)
-            }
+        metadata = _scan_metadata(message)
+        course_name = metadata["course"]
+        if course_name is None:
+            return self._reply(
+                "Please specify a course name in square brackets, e.g. [Course Name]",
+                "canvas_post"
+            )
         
-        course_name = course_match.group(1)
-        title = self._extract_title(message)
+        title = metadata["title"]
         
+        # Clean content using LLM, generating a missing title and looking up the course alongside it;
+        # the lookup fills the agent's course id cache for the confirmation step
+        calls = [
+            self._clean_content_with_llm(message, "announcement"),
+            self.canvas_agent.get_course_id(course_name)
+        ]
         if not title:
-            title = await self.canvas_agent.announcement_agent.generate_title(message)
-        
-        # Clean content using LLM
-        cleaned_content = await self._clean_content_with_llm(message, "announcement")
+            calls.append(self.canvas_agent.announcement_agent.generate_title(message))
+        cleaned_content, course_id, *generated_title = await asyncio.gather(*calls)
+        if not course_id:
+            return self._reply(f"Could not find course: {course_name}", "canvas_post")
+        if generated_title:
+            title = generated_title[0]
         
             # Handle file upload case
         if isinstance(content, dict) and content.get("file_content"):
-            self.pending_announcement = {
+            pending = {
                 "course_name": course_name,
                 "content": cleaned_content,
                 "title": title,
@@ -687,41 +1104,36 @@ class CanvasGPTSupervisor:
                 "filename": content.get("filename")
             }
         else:
-            self.pending_announcement = {
+            pending = {
                 "course_name": course_name,
                 "content": cleaned_content,
                 "title": title
             }
+        self.pending = ("announcement", pending)
         
+        attachment = f"File to be uploaded: {pending['filename']}\n\n" if "file_content" in pending else ""
         response = (
             f"Here's the announcement for {course_name}:\n"
             f"Title: {title}\n"
-            f"{self.pending_announcement['content']}\n\n"
+            f"{pending['content']}\n\n"
+            f"{attachment}"
+            "Would you like me to post this announcement? (Reply with 'yes' to post or 'no' to cancel)"
         )
         
-        if "file_content" in self.pending_announcement:
-            response += f"File to be uploaded: {self.pending_announcement['filename']}\n\n"
-        
-        response += "Would you like me to post this announcement? (Reply with 'yes' to post or 'no' to cancel)"
-        
-        return {
-            "response": response,
-            "agent": "canvas_post",
-            "conversation_id": id(self.state)
-        }
+        return self._reply(response, "canvas_post")
     async def _handle_quiz_confirmation(self) -> Dict[str, str]:
         """Handle confirmation for quiz creation"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_quiz",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_quiz"
+            )
 
         try:
-            course_name = self.pending_quiz['course_name']
-            content = self.pending_quiz['content']
-            title = self.pending_quiz['title']
+            _, pending = self.pending
+            course_name = pending['course_name']
+            content = pending['content']
+            title = pending['title']
             
             quiz_result = await self.canvas_agent.process(
                 content,
@@ -733,35 +1145,31 @@ class CanvasGPTSupervisor:
             else:
                 response = f"Failed to create quiz: {quiz_result.get('message', 'Unknown error')}"
                 
-            self.pending_quiz = None
+            self.pending = None
                 
         except Exception as e:
             response = f"Error creating quiz: {str(e)}"
         
-        return {
-            "response": response,
-            "agent": "canvas_quiz",
-            "conversation_id": id(self.state)
-        }
+        return self._reply(response, "canvas_quiz")
 
 
     async def _handle_announcement_confirmation(self) -> Dict[str, str]:
         """Handle confirmation for announcement posting"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_post",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_post"
+            )
 
         try:
-            course_name = self.pending_announcement['course_name']
-            content = self.pending_announcement['content']
-            title = self.pending_announcement['title']
+            _, pending = self.pending
+            course_name = pending['course_name']
+            content = pending['content']
+            title = pending['title']
             
             # Get file content if present
-            file_content = self.pending_announcement.get('file_content')
-            file_name = self.pending_announcement.get('filename')  # This needs to be changed to 'file_name'
+            file_content = pending.get('file_content')
+            file_name = pending.get('filename')  # This needs to be changed to 'file_name'
             
             if file_content and file_name:
                 # Create dictionary format for content
@@ -785,158 +1193,125 @@ class CanvasGPTSupervisor:
             else:
                 response = f"Failed to post announcement: {result.get('message', 'Unknown error')}"
                 
-            self.pending_announcement = None
+            self.pending = None
             
-            return {
-                "response": response,
-                "agent": "canvas_post",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(response, "canvas_post")
                 
         except Exception as e:
-            logger.error(f"Error posting announcement: {str(e)}")
-            return {
-                "response": f"Error posting announcement: {str(e)}",
-                "agent": "canvas_post",
-                "conversation_id": id(self.state)
-            }
+            logger.error("Error posting announcement: %s", e)
+            return self._reply(f"Error posting announcement: {str(e)}", "canvas_post")
 
 
 
     async def _handle_assignment_confirmation(self) -> Dict[str, str]:
         """Handle confirmation for assignment creation with file upload support"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_assignment",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_assignment"
+            )
 
         try:
-            # Get course ID
-            course_id = await self.canvas_agent.get_course_id(self.pending_assignment['course_name'])
+            _, pending = self.pending
+            # Get course ID, unless it was resolved while the assignment was prepared
+            course_id = pending.get('course_id') or await self.canvas_agent.get_course_id(pending['course_name'])
             if "extracted_content" in self.state.context:
-                self.pending_assignment["content"] = self.state.context["extracted_content"]
+                pending["content"] = self.state.context["extracted_content"]
                 logger.info("Using extracted content for assignment creation")
-                logger.info(f"Content being used: {self.pending_assignment['content']}")
+                logger.debug("Content being used: %s", pending['content'])
             if not course_id:
-                return {
-                    "response": f"Could not find course: {self.pending_assignment['course_name']}",
-                    "agent": "canvas_assignment",
-                    "conversation_id": id(self.state)
-                }
+                return self._reply(f"Could not find course: {pending['course_name']}", "canvas_assignment")
             
             # If we have a file, use the new process_file_and_create_assignment method
-            if "file_content" in self.pending_assignment:
+            if "file_content" in pending:
                 result = await self.canvas_agent.assignment_agent.process_file_and_create_assignment(
                     course_id=course_id,
-                    file_content=self.pending_assignment['file_content'],
-                    file_name=self.pending_assignment['file_name'],
-                    title=self.pending_assignment['title'],
-                    description=self.pending_assignment['content'],
-                    points=self.pending_assignment['points'],
-                    submission_types=self.pending_assignment['submission_types']
+                    file_content=pending['file_content'],
+                    file_name=pending['file_name'],
+                    title=pending['title'],
+                    description=pending['content'],
+                    points=pending['points'],
+                    submission_types=pending['submission_types']
                 )
             else:
                 # Regular assignment creation without file
                 result = await self.canvas_agent.assignment_agent.create_assignment(
                     course_id=course_id,
-                    name=self.pending_assignment['title'],
-                    description=self.pending_assignment['content'],
-                    points=self.pending_assignment['points'],
-                    submission_types=self.pending_assignment['submission_types']
+                    name=pending['title'],
+                    description=pending['content'],
+                    points=pending['points'],
+                    submission_types=pending['submission_types']
                 )
             
             if result.get("error"):
                 response = f"Failed to create assignment: {result['error']}"
             else:
-                response = f"Successfully created assignment in {self.pending_assignment['course_name']}!"
+                response = f"Successfully created assignment in {pending['course_name']}!"
                 if "file_url" in result:
                     response += f"\nFile uploaded and attached to the assignment."
             
-            self.pending_assignment = None
+            self.pending = None
             
-            return {
-                "response": response,
-                "agent": "canvas_assignment",
-                "conversation_id": id(self.state),
-                "success": "error" not in result
-            }
+            return self._reply(response, "canvas_assignment", success="error" not in result)
             
         except Exception as e:
-            logger.error(f"Error creating assignment: {str(e)}")
-            return {
-                "response": f"Error creating assignment: {str(e)}",
-                "agent": "canvas_assignment",
-                "conversation_id": id(self.state),
-                "success": False
-            }        
+            logger.error("Error creating assignment: %s", e)
+            return self._reply(
+                f"Error creating assignment: {str(e)}",
+                "canvas_assignment", success=False
+            )
         
 
+    # Confirmation handler per pending operation kind, shared by all instances
+    _CONFIRMATION_HANDLERS = {
+        "quiz": _handle_quiz_confirmation,
+        "announcement": _handle_announcement_confirmation,
+        "assignment": _handle_assignment_confirmation,
+        "page": _handle_page_confirmation
+    }
+
     def _handle_cancellation(self) -> Dict[str, str]:
         """Handle cancellation of pending operations"""
-        if self.pending_quiz:
-            self.pending_quiz = None
-            return {
-                "response": "Quiz creation cancelled.",
-                "agent": "canvas_quiz",
-                "conversation_id": id(self.state)
-            }
-        elif self.pending_announcement:
-            self.pending_announcement = None
-            return {
-                "response": "Announcement cancelled.",
-                "agent": "canvas_post",
-                "conversation_id": id(self.state)
-            }
-        elif self.pending_assignment:
-            self.pending_assignment = None
-            return {
-                "response": "Assignment creation cancelled.",
-                "agent": "canvas_assignment",
-                "conversation_id": id(self.state)
-            }
-        elif self.pending_page:  # Add this block
-            self.pending_page = None
-            return {
-                "response": "Page creation cancelled.",
-                "agent": "canvas_page",
-                "conversation_id": id(self.state)
-            }
-        return {
-            "response": "Nothing to cancel.",
-            "agent": "general",
-            "conversation_id": id(self.state)
-        }
+        if self.pending:
+            kind, _ = self.pending
+            self.pending = None
+            response, agent = CANCEL_RESPONSES[kind]
+            return self._reply(response, agent)
+        return self._reply("Nothing to cancel.", "general")
 
     async def _handle_quiz_request(self, message: str, content: str) -> Dict[str, str]:
         """Handle quiz creation requests"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_quiz",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_quiz"
+            )
 
-        course_match = re.search(r'\[(.*?)\]', message)
+        course_match = COURSE_RE.search(message)
         if not course_match:
-            return {
-                "response": "Please specify a course name in square brackets, e.g. [Course Name]",
-                "agent": "canvas_quiz",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Please specify a course name in square brackets, e.g. [Course Name]",
+                "canvas_quiz"
+            )
         
         course_name = course_match.group(1)
         title = self._extract_title(message) or "Quiz"
         
-        # Clean content using LLM
-        cleaned_content = await self._clean_content_with_llm(message, "quiz")
+        # Clean content using LLM; the course lookup alongside it fills the agent's course id
+        # cache, so the confirmation doesn't wait on Canvas
+        cleaned_content, course_id = await asyncio.gather(
+            self._clean_content_with_llm(message, "quiz"),
+            self.canvas_agent.get_course_id(course_name)
+        )
+        if not course_id:
+            return self._reply(f"Could not find course: {course_name}", "canvas_quiz")
         
-        self.pending_quiz = {
+        pending = {
             "course_name": course_name,
             "content": cleaned_content,
             "title": title
         }
+        self.pending = ("quiz", pending)
         
         response = (
             f"I've prepared the quiz for {course_name}:\n"
@@ -945,169 +1320,344 @@ class CanvasGPTSupervisor:
             "Would you like me to create this quiz? (Reply with 'yes' to create or 'no' to cancel)"
         )
         
-        return {
-            "response": response,
-            "agent": "canvas_quiz",
-            "conversation_id": id(self.state)
-        }
+        return self._reply(response, "canvas_quiz")
 
 
+    @staticmethod
+    def _format_course(course: Dict[str, Any]) -> str:
+        line = f"• {course['name']} (Code: {course['code']})"
+        students = course.get('students')
+        return f"{line} - {students} students" if students else line
+
     async def _handle_list_request(self) -> Dict[str, str]:
         """Handle course listing requests"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_list",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_list"
+            )
 
         courses = await self.get_available_courses()
         if courses:
-            course_list = "\n".join([
-                f"• {course['name']} (Code: {course['code']})"
-                + (f" - {course['students']} students" if course.get('students') else "")
-                for course in courses
-            ])
-            response = f"Available courses:\n{course_list}"
+            # The agent returns the same list object while it is cached, so its listing is reused too
+            if self._course_listing is None or self._course_listing[0] is not courses:
+                course_list = "\n".join([self._format_course(course) for course in courses])
+                self._course_listing = (courses, f"Available courses:\n{course_list}")
+            response = self._course_listing[1]
         else:
             response = "No courses found or error retrieving courses."
         
+        return self._reply(response, "canvas_list")
+
+    def _parse_assignment_request(self, message: str) -> Optional[Dict[str, Any]]:
+        """Extract course, title, points and submission types, or None without a course"""
+        course_match = COURSE_RE.search(message)
+        if not course_match:
+            return None
+        points_match = POINTS_RE.search(message)
         return {
-            "response": response,
-            "agent": "canvas_list",
-            "conversation_id": id(self.state)
+            "course_name": course_match.group(1),
+            "title": self._extract_title(message),
+            "points": int(points_match.group(1)) if points_match else 100,
+            "submission_types": self.canvas_agent.parse_submission_types(message)
         }
 
     async def _handle_assignment_request(self, message: str, content: Union[str, Dict]) -> Dict[str, str]:
         """Handle assignment creation requests with file upload support"""
         if not self.canvas_agent:
-            return {
-                "response": "Canvas is not configured. Please provide Canvas API credentials.",
-                "agent": "canvas_assignment",
-                "conversation_id": id(self.state)
-            }
+            return self._reply(
+                "Canvas is not configured. Please provide Canvas API credentials.",
+                "canvas_assignment"
+            )
 
-        # Extract course name
-        course_match = re.search(r'\[(.*?)\]', message)
-        if not course_match:
-            return {
-                "response": "Please specify a course name in square brackets, e.g. [Course Name]",
-                "agent": "canvas_assignment",
-                "conversation_id": id(self.state)
-            }
+        # Large pasted assignment bodies are parsed off the event loop
+        if len(message) < PARSE_OFFLOAD_THRESHOLD:
+            parsed = self._parse_assignment_request(message)
+        else:
+            parsed = await asyncio.to_thread(self._parse_assignment_request, message)
+        if not parsed:
+            return self._reply(
+                "Please specify a course name in square brackets, e.g. [Course Name]",
+                "canvas_assignment"
+            )
         
-        course_name = course_match.group(1)
-        title = self._extract_title(message)
-        points_match = re.search(r'points\s*should\s*be\s*(\d+)', message)
-        points = int(points_match.group(1)) if points_match else 100
+        course_name = parsed["course_name"]
+        title = parsed["title"]
+        points = parsed["points"]
+        submission_types = parsed["submission_types"]
         
-        # Clean content using LLM
-        cleaned_content = await self._clean_content_with_llm(message, "assignment")
+        # Clean content using LLM while the course id is looked up for the confirmation step
+        cleaned_content, course_id = await asyncio.gather(
+            self._clean_content_with_llm(message, "assignment"),
+            self.canvas_agent.get_course_id(course_name),
+            return_exceptions=True
+        )
+        if isinstance(cleaned_content, BaseException):
+            raise cleaned_content
+        if isinstance(course_id, BaseException):
+            logger.warning("Course lookup failed, retrying at confirmation: %s", course_id)
+            course_id = None
 
         if isinstance(content, dict) and content.get("file_content"):
-            self.pending_assignment = {
+            pending = {
                 "course_name": course_name,
+                "course_id": course_id,
                 "content": cleaned_content,
                 "title": title,
                 "points": points,
-                "submission_types": self.canvas_agent.parse_submission_types(message),
+                "submission_types": submission_types,
                 "file_content": content["file_content"],
                 "file_name": content.get("filename")
             }
         else:
             # Store as pending assignment without file
-            self.pending_assignment = {
+            pending = {
                 "course_name": course_name,
+                "course_id": course_id,
                 "content": cleaned_content,
                 "title": title,
                 "points": points,
-                "submission_types": self.canvas_agent.parse_submission_types(message)
+                "submission_types": submission_types
             }
+        self.pending = ("assignment", pending)
         
+        attachment = f"File to be attached: {pending['file_name']}\n\n" if "file_content" in pending else ""
         response = (
             f"I've prepared the assignment for {course_name}:\n"
             f"Title: {title}\n"
             f"Points: {points}\n"
             f"Content:\n{cleaned_content}\n\n"
+            f"{attachment}"
+            "Would you like me to create this assignment? (Reply with 'yes' to create or 'no' to cancel)"
         )
         
-        if "file_content" in self.pending_assignment:
-            response += f"File to be attached: {self.pending_assignment['file_name']}\n\n"
-        
-        response += "Would you like me to create this assignment? (Reply with 'yes' to create or 'no' to cancel)"
-        
-        return {
-            "response": response,
-            "agent": "canvas_assignment",
-            "conversation_id": id(self.state)
-        }
+        return self._reply(response, "canvas_assignment")
+
+    @_singleflight
+    async def _handle_web_search(self, message: str, context: str, async_mode: bool = False) -> Dict[str, str]:
+        """Handle web search requests, optionally queueing them and returning a task id"""
+        if async_mode:
+            task_id = self._submit_task(self._handle_web_search(message, context))
+            return self._reply(
+                f"Web search queued. Check /tasks/{task_id} for the result.",
+                "web_search", task_id=task_id, status="queued"
+            )
 
-    async def _handle_web_search(self, message: str, context: str) -> Dict[str, str]:
-        """Handle web search requests"""
-        response = await self.web_agent.process(
-            message,
-            conversation_context=context if context else None
-        )
+        # Web results go stale, so they live in a short-TTL cache keyed on the whitespace-normalized
+        # query; case is kept because URL paths are case-sensitive
+        query = " ".join(message.split())
+        response = _web_search_cache.get(query, WEB_SEARCH_CACHE_NAMESPACE, WEB_SEARCH_PROMPT_VERSION)
+        if response is None:
+            try:
+                async with self._admitted():
+                    response = await asyncio.wait_for(
+                        self.web_agent.process(message, conversation_context=context if context else None),
+                        timeout=self.llm_timeout
+                    )
+            except TimeoutError:
+                logger.warning("Web search timed out after %ss", self.llm_timeout)
+                return self._reply(TIMEOUT_RESPONSE, "web_search", error="timeout")
+            # Only answers that cite a source are worth reusing; failures are returned without one
+            if "\n\nSource" in response:
+                _web_search_cache.set(query, response, WEB_SEARCH_CACHE_NAMESPACE, WEB_SEARCH_PROMPT_VERSION)
         
-        return {
-            "response": response,
-            "agent": "web_search",
-            "conversation_id": id(self.state)
-        }
-
+        return self._reply(response, "web_search")
+
+    def _submit_task(self, coro) -> str:
+        """Run a handler coroutine in the background and return the id to poll it by"""
+        task_id = uuid.uuid4().hex
+        self._tasks[task_id] = {"status": "queued", "result": None, "error": None}
+        while len(self._tasks) > MAX_TRACKED_TASKS:
+            oldest_id = next(iter(self._tasks))
+            if self._tasks[oldest_id]["status"] in ("queued", "running"):
+                break
+            del self._tasks[oldest_id]
+
+        async def run():
+            record = self._tasks[task_id]
+            record["status"] = "running"
+            try:
+                record["result"] = await coro
+                record["status"] = "done"
+            except Exception as e:
+                logger.error("Background task %s failed: %s", task_id, e)
+                record["status"], record["error"] = "error", str(e)
+            finally:
+                self._background_tasks.discard(task)
+
+        task = asyncio.create_task(run())
+        self._background_tasks.add(task)
+        return task_id
+
+    def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Return the status record of a background task, if known"""
+        return self._tasks.get(task_id)
+
+    def _fast_reply(self, message_lower: str) -> Optional[str]:
+        """Canned reply for a trivial greeting or thanks, or None if the LLM should answer"""
+        if not self.fast_replies_enabled:
+            return None
+        return FAST_REPLIES.get(message_lower.rstrip("!.? "))
+
+    async def _handle_general_request_stream(self, message: str, context: str) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a general LLM response as delta events followed by a terminal done event"""
+        # The current message is already in the history, so one entry means no earlier turns
+        reply = self._fast_reply(message.strip().lower()) if len(self.state.messages) <= 1 else None
+        if reply is not None:
+            yield {"delta": reply, "agent": "general", "conversation_id": self.state.conversation_id}
+            yield {"done": True, "agent": "general", "conversation_id": self.state.conversation_id}
+            return
+
+        # Static instructions first, then prior turns oldest-first, so each request extends
+        # a byte-stable prefix that the provider's prompt cache can reuse. Older turns are
+        # summarized off the request path, since this turn only sends the recent window
+        if context:
+            self._schedule_compaction()
+        history = self._get_history_messages() if context else []
+        if not history or not isinstance(history[-1], HumanMessage):
+            history.append(HumanMessage(content=message))
+
+        parts = []
+        async with self._admitted():
+            stream = aiter(self.llm.astream([GENERAL_SYSTEM_MESSAGE, *history]))
+            while True:
+                # Bound the wait for each chunk, not the consumer's time between yields
+                try:
+                    async with asyncio.timeout(self.llm_timeout):
+                        chunk = await anext(stream)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    logger.warning("General LLM response stalled for %ss, giving up", self.llm_timeout)
+                    await stream.aclose()
+                    yield {"delta": ("\n\n" if parts else "") + TIMEOUT_RESPONSE, "error": "timeout",
+                           "agent": "general", "conversation_id": self.state.conversation_id}
+                    yield {"done": True, "agent": "general", "conversation_id": self.state.conversation_id}
+                    return
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield {"delta": chunk.content, "agent": "general", "conversation_id": self.state.conversation_id}
+
+        yield {"done": True, "agent": "general", "conversation_id": self.state.conversation_id}
+
+    @_singleflight
     async def _handle_general_request(self, message: str, context: str) -> Dict[str, str]:
         """Handle general requests using LLM"""
-        if context:
-            llm_prompt = (
-                f"{context}\n"
-                "Please provide a response considering the conversation history above."
-            )
-        else:
-            llm_prompt = message
-            
-        response = await self.llm.apredict(llm_prompt)
+        parts, error = [], None
+        async for event in self._handle_general_request_stream(message, context):
+            if "delta" in event:
+                parts.append(event["delta"])
+            error = event.get("error", error)
         
-        return {
-            "response": response,
-            "agent": "general",
-            "conversation_id": id(self.state)
-        }
+        response = self._reply("".join(parts), "general")
+        if error:
+            response["error"] = error
+        return response
+
+    async def process_message_stream(self, message: str) -> AsyncIterator[Dict[str, Any]]:
+        """Process a text message, streaming general LLM answers token by token
+
+        Every other route is answered through process_message and emitted as a
+        single delta event, so callers always receive deltas and a done event.
+        """
+        try:
+            lower_message = message.strip().lower()
+            if (self.pending and lower_message in CONFIRM_WORDS) or lower_message in CANCEL_WORDS:
+                route = None
+            elif lower_message in CONFIRM_WORDS or (not self.state.messages and self._fast_reply(lower_message)):
+                route = "general"
+            else:
+                # Cached, so process_message won't pay for routing a second time
+                route = await self._route_message(message, lower_message)
+
+            if route in NON_GENERAL_ROUTES or route is None:
+                result = await self.process_message(message, message_lower=lower_message)
+                yield {"delta": result["response"], "agent": result["agent"],
+                       "conversation_id": result["conversation_id"]}
+                yield {"done": True, "agent": result["agent"], "conversation_id": result["conversation_id"]}
+                return
+
+            self._add_message(Message(content=message, type="text", role="user", metadata={"has_file": False}))
+            parts = []
+            async for event in self._handle_general_request_stream(message, self._get_conversation_context(message)):
+                if "delta" in event:
+                    parts.append(event["delta"])
+                yield event
+            self._add_message(Message(
+                content="".join(parts)[:HISTORY_SNIPPET_LEN],
+                type="text",
+                role="assistant",
+                metadata={"agent": "general"}
+            ))
+
+        except Exception as e:
+            logger.error("Error streaming message: %s", e)
+            yield {
+                "error": f"Error processing message: {str(e)}",
+                "agent": "error",
+                "conversation_id": self.state.conversation_id,
+                "done": True
+            }
 
     async def get_state(self) -> Dict[str, Any]:
-        """Return current supervisor state"""
-        return self.state.dict()
+        """Return current supervisor state, serialized only after it changes"""
+        if self._state_dump is None:
+            self._state_dump = self.state.model_dump(mode="json")
+        return self._state_dump
+
+    async def get_state_bytes(self) -> bytes:
+        """Return current supervisor state as JSON bytes, serialized only after it changes"""
+        if self._state_bytes is None:
+            # pydantic's Rust serializer encodes straight to JSON without an intermediate dict
+            self._state_bytes = self.state.model_dump_json().encode()
+        return self._state_bytes
+
+    @staticmethod
+    def _history_entry(msg: Message) -> Dict[str, Any]:
+        return {
+            "role": msg.role,
+            "content": msg.content,
+            "metadata": msg.metadata
+        }
 
     def get_conversation_history(self) -> List[Dict[str, str]]:
-        """Get formatted conversation history"""
-        return [
-            {
-                "role": msg.role,
-                "content": msg.content,
-                "metadata": msg.metadata
-            }
-            for msg in self.state.messages
-        ]
+        """Get formatted conversation history, rebuilt only after the messages change"""
+        if self._history_cache is None:
+            self._history_cache = [self._history_entry(msg) for msg in self.state.messages]
+        # Callers get their own list, so appending to it can't corrupt the cache
+        return list(self._history_cache)
+
+    async def _close_all(self, agents: List[Any]):
+        """Close agents concurrently, logging failures without masking the other closes"""
+        results = await asyncio.gather(*(agent.close() for agent in agents), return_exceptions=True)
+        for agent, result in zip(agents, results):
+            if isinstance(result, Exception):
+                logger.error("Error closing %s: %s", type(agent).__name__, result)
+
+    async def reset_state(self, preserve_id: bool = False):
+        """Reset supervisor state, optionally keeping the conversation id for a soft reset"""
+        if preserve_id:
+            self.state = SupervisorState(conversation_id=self.state.conversation_id)
+        else:
+            self.state = SupervisorState()
+        self.pending = None  # Clear any pending operation
+        self._mark_state_changed()
+        # Agents keep their HTTP sessions and connection pools; only close() tears them down
+        await self.web_agent.reset_conversation_state()
+        logger.info("Supervisor state fully reset")
 
-    async def reset_state(self):
-        """Reset supervisor state"""
-        self.state = SupervisorState()
-        self.web_agent = WebSearchAgent()  # Create new web agent instance
-        self.pending_announcement = None  # Clear any pending announcements
-        self.pending_quiz = None  # Clear any pending quizzes
-        self.pending_assignment = None  # Clear any pending assignments
-        self.pending_page = None  # Clear any pending pages - Add this line
+    async def start(self):
+        """Open pooled Canvas connections before the first request"""
         if self.canvas_agent:
-            await self.canvas_agent.close()  # Close any existing Canvas sessions
-        logger.info("Supervisor state fully reset")
+            await self.canvas_agent.open()
+        logger.info("CanvasGPT Supervisor started")
 
     async def close(self):
-        """Cleanup method for closing all agent sessions"""
-        if hasattr(self, 'web_agent'):
-            await self.web_agent.close()
-        if hasattr(self, 'canvas_agent'):
-            await self.canvas_agent.close()
-        if hasattr(self, 'document_handler'):
-            await self.document_handler.close()
-        if hasattr(self, 'pdf_listing_agent'):
-            await self.pdf_listing_agent.close()
-        logger.info("All agent sessions closed")
\ No newline at end of file
+        """Cleanup method for closing all agent sessions; repeated calls are no-ops"""
+        closables, self._closables = self._closables, []
+        if not closables:
+            return
+        if self._compaction is not None:
+            self._compaction.cancel()
+        await self._close_all(closables)
+        logger.info("All agent sessions closed")
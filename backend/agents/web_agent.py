@@ -1,7 +1,7 @@
 import aiohttp
 import logging
 from bs4 import BeautifulSoup
-from langchain_openai import ChatOpenAI
+from .llm_clients import get_chat_llm
 from duckduckgo_search import DDGS
 import asyncio
 import re
@@ -16,7 +16,7 @@ logger = logging.getLogger(__name__)
 class WebSearchAgent:
     def __init__(self):
         self.session = None
-        self.llm = ChatOpenAI()
+        self.llm = get_chat_llm()
         self.last_search_time = 0
         self.min_search_interval = 1
         logger.info("Web Search Agent initialized")
@@ -137,6 +137,10 @@ class WebSearchAgent:
             logger.error(f"Error processing query: {str(e)}")
             return "I encountered an error while processing your request. Please try again."
 
+    async def reset_conversation_state(self):
+        """Clear per-conversation state while keeping the HTTP session and its connection pool"""
+        self.last_search_time = 0
+
     async def close(self):
         """Clean up resources"""
         if self.session:
@@ -1,16 +1,50 @@
-from fastapi import FastAPI, UploadFile, Form, File, Body
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, Form, File, Body, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from typing import Optional
 import os
 from dotenv import load_dotenv
 from agents.supervisor import CanvasGPTSupervisor
 from pydantic import BaseModel
-from io import BytesIO  
+import json
+import logging
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+# The application entrypoint owns logging configuration
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the supervisor and its pooled sessions once, and close them on shutdown"""
+    # Initialize supervisor with Canvas credentials
+    supervisor = CanvasGPTSupervisor(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        canvas_api_key=os.getenv("CANVAS_API_KEY"),
+        canvas_base_url=os.getenv("CANVAS_BASE_URL"),
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        s3_bucket_name=os.getenv("S3_BUCKET_NAME"),
+        s3_books_folder=os.getenv("S3_BOOKS_FOLDER"),
+        nvidia_api_key=os.getenv("NVIDIA_API_KEY"),
+        nvidia_api_url=os.getenv("NVIDIA_API_URL"),
+        pinecone_index_name=os.getenv("PINECONE_INDEX_NAME"),
+        pinecone_api_key=os.getenv("PINECONE_API_KEY"),
+    )
+    await supervisor.start()
+    app.state.supervisor = supervisor
+    try:
+        yield
+    finally:
+        await supervisor.close()
+
+def get_supervisor(request: Request) -> CanvasGPTSupervisor:
+    return request.app.state.supervisor
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -24,38 +58,45 @@ app.add_middleware(
 # Pydantic model for JSON payload
 class QueryRequest(BaseModel):
     query: str
+    async_mode: bool = False  # queue slow work such as web searches and return a task id
 
-# Initialize supervisor with Canvas credentials
-supervisor = CanvasGPTSupervisor(
-    openai_api_key=os.getenv("OPENAI_API_KEY"),
-    canvas_api_key=os.getenv("CANVAS_API_KEY"),
-    canvas_base_url=os.getenv("CANVAS_BASE_URL"),
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    s3_bucket_name=os.getenv("S3_BUCKET_NAME"),
-    s3_books_folder=os.getenv("S3_BOOKS_FOLDER"),
-    nvidia_api_key=os.getenv("NVIDIA_API_KEY"),
-    nvidia_api_url=os.getenv("NVIDIA_API_URL"),
-    pinecone_index_name=os.getenv("PINECONE_INDEX_NAME"),
-    pinecone_api_key=os.getenv("PINECONE_API_KEY"),
-)
 @app.post("/agent-workflow")
 async def process_message(
     request: QueryRequest = Body(...),  # For JSON payload
+    supervisor: CanvasGPTSupervisor = Depends(get_supervisor)
 ):
     try:
         # Process message through supervisor
         result = await supervisor.process_message(
             message=request.query,
-            file_content=None
+            file_content=None,
+            async_mode=request.async_mode
         )
 
         return result
 
     except Exception as e:
         return {"error": f"Error processing request: {str(e)}"}
+
+@app.post("/agent-workflow/stream")
+async def process_message_stream(
+    request: QueryRequest = Body(...),
+    supervisor: CanvasGPTSupervisor = Depends(get_supervisor)
+):
+    """Stream the response as server-sent events"""
+    async def events():
+        async for event in supervisor.process_message_stream(request.query):
+            yield f"data: {json.dumps(event)}\n\n"
+
+    # Keep reverse proxies from buffering the stream and delaying the first tokens
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/test-pdf-listing")
-async def test_pdf_listing():
+async def test_pdf_listing(supervisor: CanvasGPTSupervisor = Depends(get_supervisor)):
     """Test S3 PDF listing configuration"""
     try:
         if not supervisor.pdf_listing_agent:
@@ -87,19 +128,16 @@ async def test_pdf_listing():
 @app.post("/agent-workflow/form")
 async def process_message_form(
     message: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None)
+    file: Optional[UploadFile] = File(None),
+    supervisor: CanvasGPTSupervisor = Depends(get_supervisor)
 ):
     try:
         # Handle file if present
         file_content = None
         if file:
-            content = await file.read()
-            # Create a file-like object from bytes
-            file_io = BytesIO(content)
-            file_io.name = file.filename  # Add filename attribute
-            
+            # Hand over the spooled upload itself rather than a BytesIO copy of it
             file_content = {
-                "file": file_io,        # File-like object
+                "file": file.file,      # File-like object
                 "filename": file.filename,
                 "content_type": file.content_type
             }
@@ -116,19 +154,27 @@ async def process_message_form(
         logger.error(f"Error in process_message_form: {str(e)}")
         return {"error": f"Error processing request: {str(e)}"}
 
+@app.get("/tasks/{task_id}")
+async def get_task(task_id: str, supervisor: CanvasGPTSupervisor = Depends(get_supervisor)):
+    """Endpoint to poll a queued request"""
+    task = supervisor.get_task(task_id)
+    if task is None:
+        return {"error": f"Unknown task: {task_id}"}
+    return task
+
 @app.get("/supervisor-state")
-async def get_supervisor_state():
+async def get_supervisor_state(supervisor: CanvasGPTSupervisor = Depends(get_supervisor)):
     """Endpoint to check current supervisor state"""
-    return await supervisor.get_state()
+    return Response(content=await supervisor.get_state_bytes(), media_type="application/json")
 
 @app.post("/reset-supervisor")
-async def reset_supervisor():
+async def reset_supervisor(supervisor: CanvasGPTSupervisor = Depends(get_supervisor)):
     """Endpoint to reset supervisor state"""
     await supervisor.reset_state()
     return {"status": "success", "message": "Supervisor state reset"}
 
 @app.get("/courses")
-async def list_courses():
+async def list_courses(supervisor: CanvasGPTSupervisor = Depends(get_supervisor)):
     """Endpoint to list all available courses"""
     try:
         courses = await supervisor.get_available_courses()
@@ -143,7 +189,7 @@ async def list_courses():
         }
 
 @app.get("/canvas-test")
-async def test_canvas_connection():
+async def test_canvas_connection(supervisor: CanvasGPTSupervisor = Depends(get_supervisor)):
     """Test Canvas API connection and configuration"""
     try:
         if not supervisor.canvas_agent:
@@ -0,0 +1,231 @@
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from agents.canvas.announcement import AnnouncementAgent
+from agents.canvas.assignment import AssignmentAgent
+from agents.canvas.post_agent import TEXT_RES, CanvasPostAgent
+from agents.supervisor import _scan_metadata
+
+# Expected outputs below were produced by the parsers these single-pass versions replaced
+
+WRAPPER = '<div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.5; color: #333;">\n'
+TABLE = (
+    '<div style="overflow-x: auto;">'
+    '<table style="border-collapse: collapse; width: 100%; margin: 15px 0;"><thead><tr>'
+)
+TABLE_END = '</tbody></table></div>\n'
+
+
+def p(text):
+    return f'<p style="margin: 10px 0;">{text}</p>\n'
+
+
+def th(text):
+    return f'<th style="border: 1px solid #ddd; padding: 8px; background-color: #f5f6fa;">{text}</th>'
+
+
+def tr(*cells):
+    tds = "".join(f'<td style="border: 1px solid #ddd; padding: 8px;">{cell}</td>' for cell in cells)
+    return f"<tr>{tds}</tr>"
+
+
+def question(number, text):
+    return f"<div class='question'><p><strong>Question {number}.</strong> {text}</p>"
+
+
+def options(*items):
+    return "<ul class='options'>" + "".join(f"<li>{item}</li>" for item in items) + "</ul>"
+
+
+def answer(letter):
+    return f"<p class='correct-answer'><em>Correct Answer: {letter}</em></p>"
+
+
+def questions(*blocks):
+    return "<div class='assignment-questions'>" + "".join(blocks) + "</div>"
+
+
+class TestParseQuestions:
+    @pytest.fixture
+    def agent(self):
+        return AssignmentAgent("key", "https://canvas.test")
+
+    @pytest.mark.parametrize("content, expected", [
+        pytest.param(
+            "1. What is the time complexity of binary search?\n"
+            "Options:\nA. O(n)\nB. O(log n)\nC. O(n log n)\nD. O(1)\n(Correct Answer: B)\n"
+            "2. Which structure is FIFO?\nOptions:\nA. Stack\nB. Queue\n(Correct Answer: B)",
+            questions(
+                question(1, "What is the time complexity of binary search?")
+                + options("A. O(n)", "B. O(log n)", "C. O(n log n)", "D. O(1)") + answer("B") + "</div>",
+                question(2, "Which structure is FIFO?") + options("A. Stack", "B. Queue") + answer("B") + "</div>"
+            ),
+            id="options-and-answers"
+        ),
+        pytest.param(
+            "1. Explain recursion in your own words.\n2. Describe when a stack overflows.",
+            questions(
+                question(1, "Explain recursion in your own words.") + "</div>",
+                question(2, "Describe when a stack overflows.") + "</div>"
+            ),
+            id="no-options"
+        ),
+        pytest.param(
+            "Answer every question below.\n1. Define a hash table.\n"
+            "2. Pick the stable sort\nOptions:\nA. Quicksort\nB. Merge sort\nnot an option line\nC. Heapsort",
+            questions(
+                question(1, "Define a hash table.") + "</div>",
+                question(2, "Pick the stable sort") + options("A. Quicksort", "B. Merge sort", "C. Heapsort") + "</div>"
+            ),
+            id="preamble-and-non-option-lines"
+        ),
+        pytest.param(
+            "1. Pick one (Correct Answer: C)\nOptions:\nA. x\nC. z\n(Correct Answer: A)",
+            questions(question(1, "Pick one (Correct Answer: C)") + options("A. x", "C. z") + answer("C") + "</div>"),
+            id="first-answer-wins"
+        ),
+        pytest.param(
+            "1. Q\nOptions:\nA. a\nOptions:\nB. b",
+            questions(question(1, "Q") + options("A. a", "B. b") + "</div>"),
+            id="second-options-marker"
+        ),
+        pytest.param("Just some text without numbering (Correct Answer: A)", questions(), id="no-questions"),
+        pytest.param("", questions(), id="empty"),
+    ])
+    def test_golden_output(self, agent, content, expected):
+        assert agent.parse_questions(content) == expected
+
+
+class TestFormatBasicContent:
+    @pytest.mark.parametrize("content, expected", [
+        pytest.param(
+            "Welcome back!\n\nClass starts at 9.",
+            WRAPPER + p("Welcome back!") + p("") + p("Class starts at 9.") + "</div>",
+            id="plain"
+        ),
+        pytest.param(
+            "Schedule:\n| Week | Topic |\n|------|-------|\n| 1 | Intro |\n| 2 | Trees |\nSee you there.",
+            WRAPPER + p("Schedule:")
+            + TABLE + th("Week") + th("Topic") + "</tr></thead><tbody>"
+            + tr("1", "Intro") + tr("2", "Trees") + TABLE_END
+            + p("See you there.") + "</div>",
+            id="table-between-paragraphs"
+        ),
+        pytest.param(
+            "| A | B |\n|---|---|\n| 1 | 2 |",
+            WRAPPER + TABLE + th("A") + th("B") + "</tr></thead><tbody>" + tr("1", "2") + TABLE_END + "</div>",
+            id="table-at-end"
+        ),
+        pytest.param(
+            "| H |\n|---|\n| x |\ntext\n| K | L |\n|---|---|\n| y | z |\n|---|---|",
+            WRAPPER
+            + TABLE + th("H") + "</tr></thead><tbody>" + tr("x") + TABLE_END
+            + p("text")
+            + TABLE + th("K") + th("L") + "</tr></thead><tbody>" + tr("y", "z") + TABLE_END + "</div>",
+            id="two-tables"
+        ),
+        pytest.param(
+            "| Only | Header |",
+            WRAPPER + TABLE + th("Only") + th("Header") + "</tr></thead><tbody>" + TABLE_END + "</div>",
+            id="header-only"
+        ),
+        pytest.param("", WRAPPER + p("") + "</div>", id="empty"),
+    ])
+    def test_golden_output(self, content, expected):
+        assert AnnouncementAgent._format_basic_content(content) == expected
+
+
+class TestScanMetadata:
+    @pytest.mark.parametrize("message, expected", [
+        pytest.param(
+            "create a page for [CS 101] title: Week 1 Notes link:https://example.com/notes",
+            ("CS 101", "Week 1 Notes link:https://example.com/notes", "https://example.com/notes"),
+            id="all-three"
+        ),
+        pytest.param(
+            "title: Reading link:https://example.com/a\npost to [Data Mining]",
+            ("Data Mining", "Reading link:https://example.com/a", "https://example.com/a"),
+            id="link-on-title-line"
+        ),
+        pytest.param(
+            "Post an announcement TITLE:   Exam Moved   \nto [ML]",
+            ("ML", "Exam Moved", None),
+            id="title-case-insensitive"
+        ),
+        pytest.param(
+            "[First] [Second] title: One\ntitle: Two link:http://a.io link:http://b.io",
+            ("First", "One", "http://a.io"),
+            id="first-of-each"
+        ),
+        pytest.param("post an announcement in [Algorithms]", ("Algorithms", None, None), id="course-only"),
+        pytest.param("post to [] title:\nnext line", ("", "next line", None), id="empty-brackets"),
+        pytest.param("just chatting", (None, None, None), id="nothing"),
+    ])
+    def test_golden_output(self, message, expected):
+        assert _scan_metadata(message) == dict(zip(("course", "title", "url"), expected))
+
+
+class TestPostAgentPatterns:
+    @pytest.fixture
+    def agent(self):
+        return CanvasPostAgent("key", "https://canvas.test")
+
+    @staticmethod
+    def quiz_question(text, *answers, correct):
+        return {
+            "question_name": text,
+            "question_text": text,
+            "question_type": "multiple_choice_question",
+            "points_possible": 1,
+            "answers": [{"text": answer, "weight": 100 if index == correct else 0}
+                        for index, answer in enumerate(answers)]
+        }
+
+    def test_structured_quiz(self, agent):
+        content = (
+            "1. What does RAM stand for? A. random access memory B. read and map "
+            "C. rapid array module D. run all macros (Correct Answer: A)\n"
+            "2. Which is a prime? A. 4 B. 6 C. 7 D. 9 (Correct Answer: C)"
+        )
+        assert agent.parse_structured_quiz(content) == [
+            self.quiz_question("What does RAM stand for?", "random access memory", "read and map",
+                               "rapid array module", "run all macros", correct=0),
+            self.quiz_question("Which is a prime?", "4", "6", "7", "9", correct=2),
+        ]
+
+    def test_structured_quiz_repeated_numbers(self, agent):
+        content = "1. First? A. yes B. no (Correct Answer: B)\n1. Again? A. up B. down (Correct Answer: A)"
+        assert agent.parse_structured_quiz(content) == [
+            self.quiz_question("First?", "yes", "no", correct=1),
+            self.quiz_question("Again?", "up", "down", correct=0),
+        ]
+
+    def test_structured_quiz_skips_questions_without_an_answer(self, agent):
+        content = "1. No answer here A. one B. two\n2. Has one A. x B. y (Correct Answer: B)"
+        assert agent.parse_structured_quiz(content) == [self.quiz_question("Has one", "x", "y", correct=1)]
+        assert agent.parse_structured_quiz("") == []
+
+    @pytest.mark.parametrize("message, expected", [
+        ("post this link:https://canvas.example.edu/files/1 to [CS]", "https://canvas.example.edu/files/1"),
+        ("Share LINK:https://example.com/x please", "https://example.com/x"),
+        ("read <https://example.com/paper.pdf> before class", "https://example.com/paper.pdf"),
+        ("see www.example.org/syllabus then reply", "www.example.org/syllabus"),
+        ("http://one.example and https://two.example", "http://one.example"),
+        ("no links in here", None),
+    ])
+    def test_extract_link(self, agent, message, expected):
+        assert agent._extract_link(message) == expected
+
+    @pytest.mark.parametrize("message, expected", [
+        ('create a page Text: "Line one" and more', "Line one"),
+        ("create a page Text: 'single body' trailing", "single body"),
+        ("create a page Text: rest of the line\nnext line", "rest of the line"),
+        ('Text: plain first\nText: "quoted later"', "quoted later"),
+        ("create a page without a body", None),
+    ])
+    def test_text_body_patterns_in_order(self, message, expected):
+        match = next((match for match in (pattern.search(message) for pattern in TEXT_RES) if match), None)
+        assert (match.group(1).strip() if match else None) == expected
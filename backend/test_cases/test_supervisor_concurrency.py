@@ -0,0 +1,312 @@
+import asyncio
+import json
+import os
+import re
+import time
+
+import pytest
+import pytest_asyncio
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from agents.supervisor import CanvasGPTSupervisor, Message, RouteLabel, RouteLabels, _RoutingBatcher
+
+
+class StubRouter:
+    """Structured-output router that echoes each message back as its route"""
+
+    def __init__(self, batch: bool, delay: float = 0.0):
+        self.batch = batch
+        self.delay = delay
+        self.calls = []
+
+    async def ainvoke(self, messages):
+        content = messages[-1].content
+        self.calls.append(content)
+        await asyncio.sleep(self.delay)
+        if self.batch:
+            return RouteLabels(routes=re.findall(r"Message \d+:\n(\S+)", content))
+        return RouteLabel(route=content.removeprefix("Message: "))
+
+
+class StubWebAgent:
+    """Web agent whose process() blocks on an event and counts its calls"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def process(self, message, conversation_context=None):
+        self.calls += 1
+        await self.release.wait()
+        return f"answer to {message}"
+
+    async def reset_conversation_state(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest_asyncio.fixture
+async def supervisor():
+    supervisor = CanvasGPTSupervisor("sk-test")
+    supervisor.web_agent = StubWebAgent()
+    yield supervisor
+    await supervisor.close()
+
+
+def make_batcher(delay: float = 0.0) -> _RoutingBatcher:
+    batcher = _RoutingBatcher(CanvasGPTSupervisor("sk-test").llm, window=0.05)
+    batcher._router = StubRouter(batch=False, delay=delay)
+    batcher._batch_router = StubRouter(batch=True, delay=delay)
+    return batcher
+
+
+@pytest.mark.asyncio
+class TestRoutingBatcher:
+    async def test_single_message_uses_single_router(self):
+        batcher = make_batcher()
+        assert await batcher.route("canvas_list") == "canvas_list"
+        assert len(batcher._router.calls) == 1
+        assert batcher._batch_router.calls == []
+        await batcher.close()
+
+    async def test_batch_fans_routes_out_to_their_callers(self):
+        batcher = make_batcher()
+        messages = ["canvas_quiz", "general", "web_search", "canvas_page", "rag_query"]
+        routes = await asyncio.gather(*(batcher.route(message) for message in messages))
+        assert routes == messages
+        assert len(batcher._batch_router.calls) == 1
+        assert batcher._router.calls == []
+        await batcher.close()
+
+    async def test_short_batch_answer_pads_with_general(self):
+        batcher = make_batcher()
+
+        async def two_routes(messages):
+            return RouteLabels(routes=["canvas_quiz", "canvas_page"])
+
+        batcher._batch_router.ainvoke = two_routes
+        routes = await asyncio.gather(*(batcher.route(m) for m in ["a", "b", "c"]))
+        assert routes == ["canvas_quiz", "canvas_page", "general"]
+        await batcher.close()
+
+    async def test_batch_failure_reaches_every_caller(self):
+        batcher = make_batcher()
+
+        async def fail(messages):
+            raise RuntimeError("rate limited")
+
+        batcher._batch_router.ainvoke = fail
+        results = await asyncio.gather(*(batcher.route(m) for m in ["a", "b"]), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        await batcher.close()
+
+
+@pytest.mark.asyncio
+class TestSingleflight:
+    async def test_identical_calls_share_one_execution(self, supervisor):
+        calls = [asyncio.create_task(supervisor._handle_web_search("coalesce me", "")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        supervisor.web_agent.release.set()
+        results = await asyncio.gather(*calls)
+        assert supervisor.web_agent.calls == 1
+        assert {result["response"] for result in results} == {"answer to coalesce me"}
+        assert supervisor._inflight == {}
+
+    async def test_different_inputs_run_separately(self, supervisor):
+        supervisor.web_agent.release.set()
+        await asyncio.gather(
+            supervisor._handle_web_search("first query", ""),
+            supervisor._handle_web_search("second query", "")
+        )
+        assert supervisor.web_agent.calls == 2
+
+    async def test_cancelling_one_caller_leaves_the_others_running(self, supervisor):
+        first = asyncio.create_task(supervisor._handle_web_search("shared query", ""))
+        second = asyncio.create_task(supervisor._handle_web_search("shared query", ""))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        supervisor.web_agent.release.set()
+        result = await second
+        assert first.cancelled()
+        assert result["response"] == "answer to shared query"
+        assert supervisor.web_agent.calls == 1
+
+
+@pytest.mark.asyncio
+class TestAdmission:
+    async def test_limit_bounds_concurrent_holders(self, supervisor):
+        await supervisor.set_max_inflight(2)
+        peak, release = 0, asyncio.Event()
+
+        async def hold():
+            nonlocal peak
+            async with supervisor._admitted():
+                peak = max(peak, supervisor._active)
+                await release.wait()
+
+        holders = [asyncio.create_task(hold()) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        assert supervisor._active == 2
+        release.set()
+        await asyncio.gather(*holders)
+        assert peak == 2
+        assert supervisor._active == 0
+
+    async def test_shrinking_the_limit_waits_for_in_flight_calls(self, supervisor):
+        await supervisor.set_max_inflight(3)
+        releases = [asyncio.Event() for _ in range(3)]
+        admitted = asyncio.Event()
+
+        async def hold(release):
+            async with supervisor._admitted():
+                await release.wait()
+
+        async def waiter():
+            async with supervisor._admitted():
+                admitted.set()
+
+        holders = [asyncio.create_task(hold(release)) for release in releases]
+        await asyncio.sleep(0.01)
+        assert supervisor._active == 3
+
+        await supervisor.set_max_inflight(1)
+        pending = asyncio.create_task(waiter())
+        for release in releases[:2]:
+            release.set()
+            await asyncio.sleep(0.01)
+            assert not admitted.is_set()
+        # Only once the last in-flight call leaves is the active count below the new limit
+        releases[2].set()
+        await asyncio.wait_for(pending, 1)
+        assert admitted.is_set()
+        await asyncio.gather(*holders)
+
+    async def test_growing_the_limit_wakes_waiters(self, supervisor):
+        await supervisor.set_max_inflight(1)
+        release, admitted = asyncio.Event(), asyncio.Event()
+
+        async def hold():
+            async with supervisor._admitted():
+                await release.wait()
+
+        async def waiter():
+            async with supervisor._admitted():
+                admitted.set()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        pending = asyncio.create_task(waiter())
+        await asyncio.sleep(0.01)
+        assert not admitted.is_set()
+        await supervisor.set_max_inflight(2)
+        await asyncio.wait_for(pending, 1)
+        release.set()
+        await holder
+
+
+@pytest.mark.asyncio
+class TestBackgroundTasks:
+    async def test_submitted_task_reports_its_result(self, supervisor):
+        async def work():
+            await asyncio.sleep(0.01)
+            return {"response": "done"}
+
+        task_id = supervisor._submit_task(work())
+        assert supervisor.get_task(task_id)["status"] == "queued"
+        await asyncio.sleep(0.05)
+        record = supervisor.get_task(task_id)
+        assert record["status"] == "done"
+        assert record["result"] == {"response": "done"}
+        assert supervisor._background_tasks == set()
+
+    async def test_failed_task_reports_its_error(self, supervisor):
+        async def work():
+            raise ValueError("boom")
+
+        task_id = supervisor._submit_task(work())
+        await asyncio.sleep(0.01)
+        record = supervisor.get_task(task_id)
+        assert record["status"] == "error"
+        assert record["error"] == "boom"
+
+    async def test_async_web_search_is_queued(self, supervisor):
+        supervisor.web_agent.release.set()
+        queued = await supervisor._handle_web_search("queued query", "", async_mode=True)
+        assert queued["status"] == "queued"
+        await asyncio.sleep(0.05)
+        record = supervisor.get_task(queued["task_id"])
+        assert record["status"] == "done"
+        assert record["result"]["response"] == "answer to queued query"
+
+
+class TestEndpoints:
+    @pytest.fixture
+    def client(self):
+        from fastapi.testclient import TestClient
+        import main_fastapi
+
+        with TestClient(main_fastapi.app) as client:
+            yield client
+
+    def test_unknown_task_id(self, client):
+        assert client.get("/tasks/missing").json() == {"error": "Unknown task: missing"}
+
+    def test_submitted_task_is_pollable(self, client):
+        supervisor = client.app.state.supervisor
+
+        async def work():
+            return {"response": "polled"}
+
+        async def submit():
+            return supervisor._submit_task(work())
+
+        # The app's loop runs in the TestClient's portal thread, so submit there and poll until done
+        task_id = client.portal.call(submit)
+        for _ in range(50):
+            record = client.get(f"/tasks/{task_id}").json()
+            if record["status"] == "done":
+                break
+            time.sleep(0.01)
+        assert record == {"status": "done", "result": {"response": "polled"}, "error": None}
+
+    def test_stream_sends_delta_then_done_events(self, client):
+        response = client.post("/agent-workflow/stream", json={"query": "hi"})
+        assert response.headers["content-type"].startswith("text/event-stream")
+        frames = [line.removeprefix("data: ") for line in response.text.split("\n\n") if line]
+        events = [json.loads(frame) for frame in frames]
+        assert "delta" in events[0] and events[0]["agent"] == "general"
+        assert events[-1]["done"] is True
+        assert len({event["conversation_id"] for event in events}) == 1
+
+
+@pytest.mark.asyncio
+class TestCompaction:
+    async def test_failed_summary_leaves_history_for_a_retry(self, supervisor):
+        calls = 0
+
+        async def fail(prompt):
+            nonlocal calls
+            calls += 1
+            raise RuntimeError("rate limited")
+
+        object.__setattr__(supervisor.llm, "ainvoke", fail)
+        for index in range(8):
+            supervisor._add_message(Message(content=f"turn {index}", role="user", tokens=2000))
+        messages = supervisor.state.messages
+        history = supervisor.get_conversation_history()
+
+        supervisor._schedule_compaction()
+        await supervisor._compaction
+        # Neither the message list nor the cached history views were touched
+        assert supervisor.state.messages is messages
+        assert supervisor._history_cache is not None
+        assert supervisor.get_conversation_history() == history
+        assert supervisor._compaction is None
+
+        supervisor._schedule_compaction()
+        await supervisor._compaction
+        assert calls == 2